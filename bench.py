@@ -0,0 +1,275 @@
+""" Rows/sec of every load strategy on tables shaped like address and company
+
+Synthetic tables are (re)created as bench_address and bench_company in both the source and the target
+database. The rows are generated from their position alone, every run
+at a given size copies the same data.
+
+Each strategy gets a full load into an empty target, then an incremental load of rows appended to the
+source after it. Rows/sec, peak RSS and round trips of every run go to a JSON file that can be diffed
+between commits.
+
+A throwaway cluster is created in a temporary directory and dropped afterwards. --use-config-databases
+runs against the databases from config.py instead, and drops and fills tables in them, so never point
+it at production.
+
+    python bench.py --rows 10000 --rows 1000000 --repeat 3 --output results.json
+"""
+import argparse
+import contextlib
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+
+import psutil
+
+import etl
+
+
+SHAPES = {
+    "address": (
+        "id",
+        [
+            etl.Column("id", "integer"),
+            etl.Column("street", "text"),
+            etl.Column("house_number", "text"),
+            etl.Column("postal_code", "text"),
+            etl.Column("city", "text"),
+            etl.Column("country", "text"),
+            etl.Column("created_at", "timestamp with time zone"),
+        ],
+        """
+        SELECT
+            i,
+            'Street ' || md5(i::text),
+            (i % 500)::text,
+            lpad((i % 99999)::text, 5, '0'),
+            'City ' || (i % 1000),
+            'Country ' || (i % 50),
+            TIMESTAMPTZ '2020-01-01' + i * INTERVAL '1 second'
+        FROM generate_series(%s, %s) AS i
+        """,
+    ),
+    "company": (
+        "company_id",
+        [
+            etl.Column("company_id", "integer"),
+            etl.Column("name", "text"),
+            etl.Column("address_id", "integer"),
+            etl.Column("created_at", "timestamp with time zone"),
+        ],
+        """
+        SELECT
+            i,
+            'Company ' || i,
+            i,
+            TIMESTAMPTZ '2020-01-01' + i * INTERVAL '1 second'
+        FROM generate_series(%s, %s) AS i
+        """,
+    ),
+}
+
+DEFAULT_ROWS = (10000, 1000000, 10000000)
+
+
+@contextlib.contextmanager
+def throwaway_cluster(bindir=None, databases=("source", "target")):
+    """ initdb a cluster in a temporary directory, start it on a socket in there and yield its connection arguments
+
+    The cluster doesn't listen on TCP, so it can't clash with a server that's already running.
+    It's stopped and deleted afterwards.
+    """
+    def tool(name):
+        return os.path.join(bindir, name) if bindir else name
+
+    with tempfile.TemporaryDirectory(prefix="etl-bench-") as directory:
+        data = os.path.join(directory, "data")
+        subprocess.run([tool("initdb"), "-D", data, "-U", "postgres", "--auth=trust"],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([tool("pg_ctl"), "-D", data, "-l", os.path.join(directory, "server.log"), "-w",
+                        "-o", f"-k {directory} -c listen_addresses=''", "start"],
+                       check=True, stdout=subprocess.DEVNULL)
+        try:
+            for db in databases:
+                subprocess.run([tool("createdb"), "-h", directory, "-U", "postgres", db], check=True)
+            yield {"host": directory, "user": "postgres"}
+        finally:
+            subprocess.run([tool("pg_ctl"), "-D", data, "-m", "fast", "-w", "stop"], stdout=subprocess.DEVNULL)
+
+
+@contextlib.contextmanager
+def peak_rss(interval: float = 0.01):
+    """ Sample this process' RSS on a thread while the block runs, yields a list holding the peak in bytes
+    """
+    process = psutil.Process()
+    peak = [process.memory_info().rss]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], process.memory_info().rss)
+
+    sampler = threading.Thread(target=sample, name="rss-sampler", daemon=True)
+    sampler.start()
+    try:
+        yield peak
+    finally:
+        done.set()
+        sampler.join()
+        peak[0] = max(peak[0], process.memory_info().rss)
+
+
+def recreate(rel: etl.Relation, columns, key):
+    with etl.connect(rel.db) as (_, curs):
+        curs.execute(f'DROP TABLE IF EXISTS "{rel.schema}"."{rel.name}";')
+    etl.make_sure_table_exists(rel, columns, key)
+
+
+def generate(rel: etl.Relation, rows_query, first: int, last: int):
+    """ Insert the synthetic rows first to last, and refresh the statistics
+    """
+    with etl.connect(rel.db) as (_, curs):
+        curs.execute(f'INSERT INTO "{rel.schema}"."{rel.name}" {rows_query};', (first, last))
+        curs.execute(f'ANALYZE "{rel.schema}"."{rel.name}";')
+
+
+def remove(rel: etl.Relation, key, after: int):
+    with etl.connect(rel.db) as (_, curs):
+        curs.execute(f'DELETE FROM "{rel.schema}"."{rel.name}" WHERE "{key}" > %s;', (after, ))
+
+
+def timed_copy(src: etl.Relation, tgt: etl.Relation, key, last_upload, strategy, copy_options):
+    """ One copy and what it took, the error instead if it failed
+    """
+    stats = etl.CopyStats()
+    loaded = None
+    with peak_rss() as peak:
+        started = time.perf_counter()
+        try:
+            loaded = etl.copy(src, tgt, key, "created_at", last_upload, strategy=strategy, stats=stats,
+                              **copy_options)
+        except Exception as e:
+            return None, {"error": repr(e)}
+        seconds = time.perf_counter() - started
+    return loaded, {
+        "seconds": seconds,
+        "rows": stats.rows_extracted,
+        "rows_per_second": stats.rows_extracted / seconds if seconds else None,
+        "peak_rss_bytes": peak[0],
+        "round_trips": stats.round_trips,
+        "batches": stats.batches,
+        "bytes_sent": stats.bytes_sent,
+    }
+
+
+def run(source_db: str, target_db: str, sizes, strategies, copy_options, repeat: int = 1,
+        incremental: float = 0.01):
+    """ Full and incremental runs of every strategy at every size, repeat times each
+
+    Returns the scenarios, each with the measurements of all its runs.
+    """
+    scenarios = []
+    for shape, (key, columns, rows_query) in SHAPES.items():
+        src = etl.Relation(source_db, "public", f"bench_{shape}")
+        tgt = etl.Relation(target_db, "public", f"bench_{shape}")
+        for rows in sizes:
+            appended = max(1, int(rows * incremental))
+            recreate(src, columns, key)
+            generate(src, rows_query, 1, rows)
+
+            for strategy in strategies:
+                full = {"name": f"{shape}/{rows}/{strategy}/full", "shape": shape, "rows": rows,
+                        "strategy": strategy, "kind": "full", "runs": []}
+                update = {"name": f"{shape}/{rows}/{strategy}/incremental", "shape": shape, "rows": appended,
+                          "strategy": strategy, "kind": "incremental", "runs": []}
+                for _ in range(repeat):
+                    recreate(tgt, columns, key)
+                    loaded, measured = timed_copy(src, tgt, key, None, strategy, copy_options)
+                    full["runs"].append(measured)
+                    report(full["name"], measured)
+                    if "error" in measured:
+                        continue
+
+                    generate(src, rows_query, rows + 1, rows + appended)
+                    try:
+                        _, measured = timed_copy(src, tgt, key, loaded, strategy, copy_options)
+                    finally:
+                        remove(src, key, rows)
+                    update["runs"].append(measured)
+                    report(update["name"], measured)
+                scenarios += [full, update]
+    return scenarios
+
+
+def report(name: str, measured):
+    if "error" in measured:
+        print(f"{name:<40} failed: {measured['error']}")
+    else:
+        print(f"{name:<40} {measured['seconds']:>8.2f}s {measured['rows_per_second'] or 0:>12,.0f} rows/s "
+              f"{measured['peak_rss_bytes'] / 2 ** 20:>8.1f} MiB {measured['round_trips']:>10,} round trips")
+
+
+def server_version(db: str) -> str:
+    with etl.connect(db) as (_, curs):
+        curs.execute("SHOW server_version;")
+        return curs.fetchone()[0]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source-db", default="source")
+    parser.add_argument("--target-db", default="target")
+    parser.add_argument("--use-config-databases", action="store_true",
+                        help="Benchmark against the servers in config.py instead of a throwaway local cluster, "
+                             "bench_* tables in them are dropped and filled")
+    parser.add_argument("--pg-bin", help="Directory with initdb, pg_ctl and createdb, PATH by default")
+    parser.add_argument("--rows", type=int, action="append",
+                        help=f"Source table size, can be repeated, {', '.join(map(str, DEFAULT_ROWS))} by default")
+    parser.add_argument("--incremental", type=float, default=0.01,
+                        help="Rows appended for the incremental runs, as a fraction of the table size")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of every scenario")
+    parser.add_argument("--batch-size", type=int, default=etl.DEFAULT_SETTINGS["batch_size"])
+    parser.add_argument("--page-size", type=int, default=etl.DEFAULT_SETTINGS["page_size"])
+    parser.add_argument("--passthrough", action="store_true", help="Load values as the text the source sent")
+    parser.add_argument("--strategy", action="append", choices=etl.STRATEGIES,
+                        help="Strategy to run, can be repeated, all of them by default")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    copy_options = {"batch_size": args.batch_size, "page_size": args.page_size, "passthrough": args.passthrough}
+    with contextlib.ExitStack() as stack:
+        if not args.use_config_databases:
+            etl.set_connect_arguments(stack.enter_context(
+                throwaway_cluster(args.pg_bin, (args.source_db, args.target_db))))
+            stack.callback(etl.set_connect_arguments, None)
+        results = {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "server_version": server_version(args.target_db),
+            "initdb": not args.use_config_databases,
+            "settings": copy_options,
+            "scenarios": run(args.source_db, args.target_db, args.rows or DEFAULT_ROWS,
+                             args.strategy or etl.STRATEGIES, copy_options, args.repeat, args.incremental),
+        }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+
+
+if __name__=='__main__':
+    main()
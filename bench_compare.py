@@ -0,0 +1,110 @@
+""" Compare two bench.py result files and fail when the candidate is slower or uses more memory
+
+Scenarios are matched by name. Throughput and peak RSS are compared by their median over the repeated
+runs, and a change only counts when it's beyond the tolerance and beyond the interquartile range of
+either side, so noise alone doesn't fail the gate. Run the benchmark with --repeat 3 or more for the
+spread to mean anything.
+
+    python bench_compare.py baseline.json candidate.json --tolerance 0.05 --memory-tolerance 0.10
+
+Exits with 1 when a scenario regressed.
+"""
+import argparse
+from collections import namedtuple
+import json
+import statistics
+import sys
+
+
+Summary = namedtuple("Summary", ("median", "iqr", "runs"))
+Comparison = namedtuple("Comparison", ("name", "metric", "baseline", "candidate", "change", "regressed", "note"))
+
+
+def load_scenarios(path: str):
+    with open(path) as file:
+        return {scenario["name"]: scenario for scenario in json.load(file)["scenarios"]}
+
+
+def summarize(values) -> Summary:
+    """ Median and interquartile range, the range is 0 with fewer than two values
+    """
+    if len(values) < 2:
+        return Summary(values[0], 0.0, len(values))
+    low, _, high = statistics.quantiles(values, n=4, method="inclusive")
+    return Summary(statistics.median(values), high - low, len(values))
+
+
+def compare_metric(name: str, metric: str, baseline: Summary, candidate: Summary, tolerance: float,
+                   higher_is_better: bool) -> Comparison:
+    change = (candidate.median - baseline.median) / baseline.median if baseline.median else 0.0
+    worse = -change if higher_is_better else change
+    # The change has to stand out from the spread of both sides, not only from the tolerance
+    noise = max(baseline.iqr, candidate.iqr) / baseline.median if baseline.median else 0.0
+    regressed = worse > tolerance and worse > noise
+    note = ""
+    if worse > tolerance and not regressed:
+        note = "within noise"
+    elif min(baseline.runs, candidate.runs) < 2:
+        note = "single run, no noise estimate"
+    return Comparison(name, metric, baseline.median, candidate.median, change, regressed, note)
+
+
+def compare(baseline, candidate, tolerance: float, memory_tolerance: float):
+    """ Comparisons of throughput and peak RSS for every scenario of the baseline
+    """
+    comparisons = []
+    for name, base in sorted(baseline.items()):
+        base_runs = [run for run in base["runs"] if "error" not in run]
+        if not base_runs:
+            continue
+        if name not in candidate:
+            comparisons.append(Comparison(name, "rows_per_second", None, None, None, False, "missing in candidate"))
+            continue
+        cand_runs = [run for run in candidate[name]["runs"] if "error" not in run]
+        if not cand_runs:
+            comparisons.append(Comparison(name, "rows_per_second", None, None, None, True, "failed in candidate"))
+            continue
+
+        comparisons.append(compare_metric(name, "rows_per_second",
+                                          summarize([run["rows_per_second"] for run in base_runs]),
+                                          summarize([run["rows_per_second"] for run in cand_runs]),
+                                          tolerance, higher_is_better=True))
+        comparisons.append(compare_metric(name, "peak_rss_bytes",
+                                          summarize([run["peak_rss_bytes"] for run in base_runs]),
+                                          summarize([run["peak_rss_bytes"] for run in cand_runs]),
+                                          memory_tolerance, higher_is_better=False))
+    return comparisons
+
+
+def print_comparisons(comparisons):
+    print(f"{'scenario':<40} {'metric':<16} {'baseline':>14} {'candidate':>14} {'change':>8}")
+    for c in comparisons:
+        if c.baseline is None:
+            values = ("-", "-", "-")
+        else:
+            values = (f"{c.baseline:,.0f}", f"{c.candidate:,.0f}", f"{c.change:+.1%}")
+        status = " ".join(part for part in ("REGRESSED" if c.regressed else "", c.note) if part)
+        print(f"{c.name:<40} {c.metric:<16} {values[0]:>14} {values[1]:>14} {values[2]:>8}  {status}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--tolerance", type=float, default=0.05,
+                        help="Largest accepted drop in rows/s, as a fraction of the baseline")
+    parser.add_argument("--memory-tolerance", type=float, default=0.10,
+                        help="Largest accepted growth of peak RSS, as a fraction of the baseline")
+    args = parser.parse_args()
+
+    comparisons = compare(load_scenarios(args.baseline), load_scenarios(args.candidate),
+                          args.tolerance, args.memory_tolerance)
+    print_comparisons(comparisons)
+    regressions = [c for c in comparisons if c.regressed]
+    if regressions:
+        print(f"{len(regressions)} regression(s)")
+        sys.exit(1)
+
+
+if __name__=='__main__':
+    main()
@@ -1,15 +1,135 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import contextlib
-from datetime import date
-from functools import namedtuple
+from datetime import date, datetime, time, timedelta, timezone
+from functools import lru_cache, namedtuple, wraps
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import psutil
 import psycopg2
-from typing import Dict, List, Union
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+import queue
+import spill
+import sys
+import threading
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+import uuid
+import warnings
 
 
-def get_connect_arguments() -> Dict[str, str]:
-    dsn = dict()
+DEFAULT_SETTINGS = {
+    # Rows fetched per round trip from the source; None loads the whole slice at once
+    "batch_size": 10000,
+    # Adapt the batch size to the width of the rows and the measured throughput, starting from batch_size
+    "adaptive_batches": False,
+    # Bytes a fetched batch may take up in memory when batches are adaptive
+    "batch_memory": 64 * 2 ** 20,
+    # Fetch values as the text the source sends and load them as is, instead of parsing them into Python
+    # objects only to turn them back into text. The watermark column's type is still parsed.
+    "passthrough": False,
+    # How rows get into the target, one of STRATEGIES
+    "strategy": "insert",
+    # Staging table kind for the copy and merge strategies, "temporary" or "unlogged". There's one unlogged
+    # staging table per target table, it can't be used with several loaders or partitions.
+    "staging": "temporary",
+    # Merge staged rows with MERGE instead of INSERT ... ON CONFLICT, PostgreSQL 15+ only
+    "use_merge": False,
+    # Rows per multi-row INSERT statement for the values strategy
+    "page_size": 1000,
+    # Threads writing fetched batches to the target while the source is still being read, 0 to alternate
+    # between reading and writing. Only used together with batch_size.
+    "loaders": 0,
+    # Fetched batches waiting for a loader, reading pauses while the queue is full
+    "queue_depth": 4,
+    # Connections kept open and the most handed out at once, per database, when pooling is enabled
+    "pool_minconn": 1,
+    "pool_maxconn": 8,
+    # Tables copied at the same time, each one holds a source and a target connection
+    "workers": 4,
+    # EXPLAIN every incremental extraction first and warn when it won't use an index
+    "preflight": False,
+    # Re-read rows this far behind the watermark, for transactions that commit late with an older timestamp
+    "lookback_seconds": 0,
+    # One of EXTRACTIONS
+    "extraction": "select",
+    # Split each table into this many parts copied by worker processes of their own, 0 or 1 to not split.
+    # Full loads are split into heap block ranges, incremental ones into key ranges. The parts of a table
+    # always read it as of one exported snapshot.
+    "partitions": 0,
+    # Have every table and partition read the source as of one exported snapshot
+    "consistent_snapshot": False,
+    # Bytes of RSS the run, worker processes included, should stay under; None to not watch memory.
+    # Getting close to it shrinks batches, holds back tables waiting to start and pauses fetching.
+    "memory_limit": None,
+    # Directory to spill extracted batches to before loading them, None to load them straight away.
+    # Every target table gets a spill of its own in there, see spill.py. Not used by keyset extractions,
+    # spilled tables aren't split into partitions and are loaded through a staging table whatever the strategy.
+    "spill_dir": None,
+    # One of SPILL_PHASES, to extract and load in separate runs
+    "spill_phase": "both",
+    # None, "gzip" or "zstd", the last one needs the zstandard package
+    "spill_compression": None,
+    # Where to write the run's metrics as a node_exporter textfile (*.prom) and as JSON, None to skip
+    "metrics_textfile": None,
+    "metrics_summary": None,
+}
+
+# Settings that are passed on to copy() as keyword arguments
+COPY_SETTINGS = ("batch_size", "strategy", "staging", "use_merge", "page_size", "loaders", "queue_depth",
+                 "adaptive_batches", "batch_memory", "passthrough")
+
+# insert: INSERT ... ON CONFLICT DO NOTHING per row
+# copy: COPY from the source piped into COPY on the target, then merged from a staging table
+# merge: every fetched batch is COPYed into a staging table and merged with one statement
+# values: multi-row INSERT ... VALUES (...), (...) ON CONFLICT DO NOTHING, for roles that can't COPY
+# pushdown: the target pulls the rows itself through a postgres_fdw foreign table, nothing passes through Python
+STRATEGIES = ("insert", "copy", "merge", "values", "pushdown")
+
+# select: one query for the whole slice
+# keyset: batch_size pages ordered by (tstz_field, key_field), each in its own transaction and checkpointed
+EXTRACTIONS = ("select", "keyset")
+
+# both: load the spill right after extracting it
+# extract: only extract, for the source's quiet hours
+# load: only load a spill extracted earlier, the source isn't read
+SPILL_PHASES = ("both", "extract", "load")
+
+# json and jsonb, psycopg2 hands those out as already parsed Python objects
+JSON_OIDS = (114, 3802)
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+PROMETHEUS_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n"})
+
+
+@lru_cache(maxsize=None)
+def load_config():
     try:
         import config
     except ImportError:
+        return None
+    return config
+
+
+_connect_arguments: Optional[Dict[str, Any]] = None
+
+
+def set_connect_arguments(dsn: Optional[Dict[str, Any]]):
+    """ Connect with these arguments instead of the ones in config.db, None to go back to config.db
+    """
+    global _connect_arguments
+    _connect_arguments = dsn
+
+
+def get_connect_arguments() -> Dict[str, str]:
+    if _connect_arguments is not None:
+        return dict(_connect_arguments)
+    dsn = dict()
+    config = load_config()
+    if config is None:
         return dsn
 
     if hasattr(config, "db") and isinstance(config.db, dict):
@@ -17,28 +137,570 @@ def get_connect_arguments() -> Dict[str, str]:
     return dsn
 
 
+def get_settings() -> Dict[str, Any]:
+    settings = dict(DEFAULT_SETTINGS)
+    config = load_config()
+    if config is None:
+        return settings
+
+    if hasattr(config, "etl") and isinstance(config.etl, dict):
+        settings.update(config.etl)
+    return settings
+
+
+class BlockingConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """ Thread safe pool that waits for a connection to be returned instead of failing once maxconn are in use
+    """
+    def __init__(self, minconn: int, maxconn: int, *args, **kwargs):
+        self._slots = threading.BoundedSemaphore(maxconn)
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def getconn(self, key=None):
+        self._slots.acquire()
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+
+_pools: Dict[str, BlockingConnectionPool] = {}
+_pool_size = None
+_pool_lock = threading.Lock()
+
+
+def enable_pooling(minconn: int = 1, maxconn: int = 8):
+    """ Make connect() hand out pooled connections, one pool per database
+    """
+    global _pool_size
+    with _pool_lock:
+        _pool_size = (minconn, maxconn)
+
+
+def close_pools():
+    """ Close every pooled connection and go back to a connection per connect() call
+    """
+    global _pool_size
+    with _pool_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+        _pool_size = None
+
+
+def get_pool(db: str) -> Optional[BlockingConnectionPool]:
+    with _pool_lock:
+        if _pool_size is None:
+            return None
+        if db not in _pools:
+            dsn = get_connect_arguments()
+            dsn["dbname"] = db
+            _pools[db] = BlockingConnectionPool(*_pool_size, **dsn)
+        return _pools[db]
+
+
+class RunMetrics:
+    """ Calls and time per operation and what every table's copy did, collected from all threads of a run
+
+    Operations in the worker processes of partitioned copies aren't seen, their rows and timings still
+    arrive through the CopyStats the processes return.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.copies = {}
+
+    def add_operation(self, operation: str, seconds: float, **labels):
+        key = (operation, tuple(sorted(labels.items())))
+        with self.lock:
+            calls, total = self.operations.get(key, (0, 0.0))
+            self.operations[key] = (calls + 1, total + seconds)
+
+    def add_copy(self, rel: "Relation", stats: "CopyStats", seconds: float):
+        with self.lock:
+            total, total_seconds = self.copies.get((rel.schema, rel.name), (CopyStats(), 0.0))
+            total.add(stats)
+            self.copies[(rel.schema, rel.name)] = (total, total_seconds + seconds)
+
+    def summary(self, success: bool) -> Dict[str, Any]:
+        with self.lock:
+            operations = [dict(labels, operation=operation, calls=calls, seconds=seconds)
+                          for (operation, labels), (calls, seconds) in sorted(self.operations.items())]
+            tables = {}
+            for (schema, name), (stats, seconds) in sorted(self.copies.items()):
+                table = {field: getattr(stats, field) for field in CopyStats.FIELDS}
+                table.update(rows_skipped=stats.rows_skipped, seconds=seconds,
+                             rows_per_second=stats.rows_extracted / seconds if seconds else None)
+                tables[f"{schema}.{name}"] = table
+        return {"finished": datetime.now(timezone.utc).isoformat(), "success": success,
+                "operations": operations, "tables": tables}
+
+    def prometheus(self, success: bool) -> str:
+        """ The metrics in the Prometheus text format, as gauges of the last run
+        """
+        samples = {
+            "etl_last_run_success": ("Whether every table of the last run was copied", [({}, int(success))]),
+            "etl_last_run_timestamp_seconds": ("When the last run finished", [({}, datetime.now().timestamp())]),
+            "etl_operation_calls": ("Calls of an operation during the last run", []),
+            "etl_operation_seconds": ("Time spent in an operation during the last run", []),
+            "etl_copy_seconds": ("Wall time of a table's copy", []),
+            "etl_copy_stage_seconds": ("Time a table's copy spent extracting, loading and committing", []),
+            "etl_copy_rows": ("Rows extracted, inserted and skipped on conflict", []),
+            "etl_copy_bytes_sent": ("Row data sent to the target", []),
+            "etl_copy_batches": ("Batches a table was copied in", []),
+            "etl_copy_round_trips": ("Statements and fetches that carried rows", []),
+        }
+        with self.lock:
+            for (operation, labels), (calls, seconds) in sorted(self.operations.items()):
+                labels = dict(labels, operation=operation)
+                samples["etl_operation_calls"][1].append((labels, calls))
+                samples["etl_operation_seconds"][1].append((labels, seconds))
+            for (schema, name), (stats, seconds) in sorted(self.copies.items()):
+                table = {"schema": schema, "table": name}
+                samples["etl_copy_seconds"][1].append((table, seconds))
+                for stage in ("extract", "load", "commit"):
+                    samples["etl_copy_stage_seconds"][1].append((dict(table, stage=stage),
+                                                                getattr(stats, f"{stage}_seconds")))
+                for kind in ("extracted", "inserted", "skipped"):
+                    samples["etl_copy_rows"][1].append((dict(table, kind=kind), getattr(stats, f"rows_{kind}")))
+                if stats.bytes_sent is not None:
+                    samples["etl_copy_bytes_sent"][1].append((table, stats.bytes_sent))
+                samples["etl_copy_batches"][1].append((table, stats.batches))
+                samples["etl_copy_round_trips"][1].append((table, stats.round_trips))
+
+        lines = []
+        for metric, (help_text, values) in samples.items():
+            if not values:
+                continue
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+            for labels, value in values:
+                label_list = ",".join(f'{name}="{str(label).translate(PROMETHEUS_ESCAPES)}"'
+                                      for name, label in labels.items())
+                lines.append(f"{metric}{{{label_list}}} {value}" if label_list else f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+_metrics = RunMetrics()
+
+
+@contextlib.contextmanager
+def measure(operation: str, **labels):
+    """ Count a call of the operation and the time spent in the block
+    """
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        _metrics.add_operation(operation, perf_counter() - started, **labels)
+
+
+def measured(operation: str):
+    """ Decorator that measures every call of the function as the operation
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(operation):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def replace_file(path: str, text: str):
+    """ Write the file next to its final place and move it there, readers never see half of it
+    """
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as file:
+        file.write(text)
+    os.replace(temporary, path)
+
+
+def write_metrics(success: bool, textfile: Optional[str] = None, summary: Optional[str] = None):
+    """ Write the run's metrics for node_exporter's textfile collector and as a JSON summary, if given paths
+    """
+    if textfile:
+        replace_file(textfile, _metrics.prometheus(success))
+    if summary:
+        replace_file(summary, json.dumps(_metrics.summary(success), indent=2) + "\n")
+
+
+class MemoryGovernor:
+    """ Keeps the RSS of this process and its children under a limit by slowing the run down
+
+    A thread samples the RSS every interval. Above the soft fraction of the limit batches are shrunk,
+    down to a tenth of their size at the limit, and tables only start while no other one is running.
+    Above the pause fraction fetching waits, for at most max_pause seconds, for memory to be freed.
+    """
+    SOFT = 0.8
+    PAUSE = 0.95
+
+    def __init__(self, limit: int, interval: float = 0.1, max_pause: float = 60.0):
+        self.limit, self.interval, self.max_pause = limit, interval, max_pause
+        self.process = psutil.Process()
+        self.rss = self.sample()
+        self.active = 0
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.run, name="memory-governor", daemon=True)
+        self.sampler.start()
+
+    def sample(self) -> int:
+        rss = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return rss
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.rss = self.sample()
+            with self.condition:
+                self.condition.notify_all()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+    @property
+    def pressure(self) -> float:
+        return self.rss / self.limit
+
+    def batch_size(self, size: int, minimum: int = 100) -> int:
+        """ The size scaled down for the memory pressure
+        """
+        if self.pressure < self.SOFT:
+            return size
+        scale = max(0.1, (1 - self.pressure) / (1 - self.SOFT))
+        return max(min(size, minimum), int(size * scale))
+
+    def wait(self):
+        """ Block while memory is close to the limit, give up after max_pause
+        """
+        if self.pressure < self.PAUSE:
+            return
+        deadline = perf_counter() + self.max_pause
+        with measure("memory_pause"), self.condition:
+            # Woken up after every sample
+            while self.pressure >= self.PAUSE and perf_counter() < deadline:
+                self.condition.wait(deadline - perf_counter())
+
+    @contextlib.contextmanager
+    def admitted(self):
+        """ Let a table start once memory is below the soft limit, or when no other table is running
+        """
+        with self.condition:
+            while self.active and self.pressure >= self.SOFT:
+                self.condition.wait(self.interval)
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+
+_governor: Optional[MemoryGovernor] = None
+
+
+def enable_memory_governor(limit: int, interval: float = 0.1):
+    """ Watch the RSS of the run and slow it down when it gets close to limit bytes
+    """
+    global _governor
+    disable_memory_governor()
+    _governor = MemoryGovernor(limit, interval)
+
+
+def disable_memory_governor():
+    global _governor
+    if _governor is not None:
+        _governor.stop()
+        _governor = None
+
+
+def governed_batch_size(size: int) -> int:
+    """ size as is, or shrunk by the memory governor, after waiting for memory if it's almost used up
+    """
+    if _governor is None:
+        return size
+    _governor.wait()
+    return _governor.batch_size(size)
+
+
 @contextlib.contextmanager
 def connect(db: str):
-    conn, cursor = None, None
+    """ Connection and cursor for the block, committed after it or rolled back if it raised
+
+    The connection goes back to its pool, or is closed, whatever happens to the transaction. A rollback
+    that fails as well doesn't replace the block's exception.
+    """
+    conn, cursor, pool = None, None, None
+    failed = False
     try:
-        dsn = get_connect_arguments()
-        dsn["dbname"] = db
-        conn = psycopg2.connect(**dsn)
+        with measure("connect", db=db):
+            pool = get_pool(db)
+            if pool:
+                conn = pool.getconn()
+            else:
+                dsn = get_connect_arguments()
+                dsn["dbname"] = db
+                conn = psycopg2.connect(**dsn)
         cursor = conn.cursor()
         yield conn, cursor
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        try:
+            # There's nothing to commit or roll back on a connection the server dropped
+            if conn and not conn.closed:
+                if not failed:
+                    conn.commit()
+                else:
+                    with contextlib.suppress(psycopg2.Error):
+                        conn.rollback()
+        finally:
+            try:
+                if cursor:
+                    cursor.close()
+            finally:
+                if conn and pool:
+                    pool.putconn(conn, close=bool(conn.closed))
+                elif conn:
+                    conn.close()
+
+
+@contextlib.contextmanager
+def server_cursor(conn, batch_size: int):
+    """ Named cursor, the result set stays on the server and is transferred batch_size rows at a time
+    """
+    curs = conn.cursor(name=f"etl_{uuid.uuid4().hex}")
+    curs.itersize = batch_size
+    try:
+        yield curs
     finally:
-        if conn:
+        curs.close()
+
+
+def latest(*values):
+    """ Greatest of the values that aren't None
+    """
+    present = [value for value in values if value is not None]
+    return max(present) if present else None
+
+
+class CopyStats:
+    """ What one copy did and where its time went, filled in by the copy functions it's passed to
+
+    Seconds are summed over everything that ran, parts copied in parallel add up to more than the wall time.
+    bytes_sent counts the row data sent to the target as COPY input or statements, it stays None for
+    strategies that don't expose it. round_trips counts the statements and fetches that carry rows,
+    executemany() makes one per row.
+    """
+    FIELDS = ("rows_extracted", "rows_inserted", "bytes_sent", "batches", "round_trips",
+              "extract_seconds", "load_seconds", "commit_seconds")
+
+    def __init__(self):
+        self.rows_extracted = 0
+        self.rows_inserted = 0
+        self.bytes_sent = None
+        self.batches = 0
+        self.round_trips = 0
+        self.extract_seconds = 0.0
+        self.load_seconds = 0.0
+        self.commit_seconds = 0.0
+
+    @property
+    def rows_skipped(self) -> int:
+        """ Extracted rows whose key already existed in the target
+        """
+        return self.rows_extracted - self.rows_inserted
+
+    def add_bytes(self, count: int):
+        self.bytes_sent = (self.bytes_sent or 0) + count
+
+    def add(self, other: "CopyStats"):
+        """ Add the counters of another copy, like one of the parts of a partitioned one
+        """
+        for field in self.FIELDS:
+            mine, theirs = getattr(self, field), getattr(other, field)
+            setattr(self, field, theirs if mine is None else mine if theirs is None else mine + theirs)
+
+    @contextlib.contextmanager
+    def timing(self, stage: str):
+        """ Add the time spent in the block to the stage, one of extract, load or commit
+        """
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            field = f"{stage}_seconds"
+            setattr(self, field, getattr(self, field) + perf_counter() - started)
+
+    def commit(self, conn):
+        """ Commit the load transaction, timed
+        """
+        with self.timing("commit"):
             conn.commit()
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+        self.round_trips += 1
+
+
+class CountingReader:
+    """ File wrapper counting the bytes read from it
+    """
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.count += len(data)
+        return data
+
+
+def timed_batches(batches: Iterator[List[tuple]], stats: CopyStats, fetched: bool = True) -> Iterator[List[tuple]]:
+    """ Pass the batches on, counting them, their rows and the time spent fetching them as extraction
+
+    With fetched, every batch and the final empty fetch are counted as a round trip to a server side cursor.
+    """
+    batches = iter(batches)
+    while True:
+        with stats.timing("extract"):
+            rows = next(batches, None)
+        stats.round_trips += fetched
+        if rows is None:
+            return
+        stats.rows_extracted += len(rows)
+        stats.batches += 1
+        yield rows
+
+
+class BatchSizer:
+    """ Batch size that follows the width of the rows and the throughput measured every round
+
+    It starts from the given size, or less if that doesn't fit the memory budget at the estimated row
+    width. After every round it keeps growing or shrinking the batches while rows/s improve and turns
+    around when they drop, and it shrinks them whenever a round takes longer than max_latency.
+    The row width is measured on the fetched rows, the size never goes over what fits the budget.
+    """
+    STEP = 1.5
+    # Less than 5% apart is the same throughput
+    MARGIN = 0.05
+
+    def __init__(self, size: int, row_bytes: int, memory: int = 64 * 2 ** 20, max_latency: float = 2.0,
+                 minimum: int = 100, maximum: int = 1000000):
+        self.memory, self.max_latency = memory, max_latency
+        self.minimum, self.maximum = minimum, maximum
+        self.row_bytes = row_bytes
+        self.size = self.bounded(size)
+        self.step = self.STEP
+        self.last_rate = None
+
+    def bounded(self, size: float) -> int:
+        return int(max(self.minimum, min(self.maximum, self.memory // max(self.row_bytes, 1), size)))
+
+    def observe(self, rows: List[tuple], seconds: float):
+        """ Adjust the size after a round that fetched and handled rows in seconds
+        """
+        self.row_bytes = (row_size(rows[0]) + row_size(rows[-1])) // 2
+        rate = len(rows) / seconds if seconds > 0 else None
+        if seconds > self.max_latency:
+            self.step = 1 / self.STEP
+        elif rate is not None and self.last_rate is not None:
+            if rate < self.last_rate * (1 - self.MARGIN):
+                self.step = 1 / self.step if self.step != 1 else 1 / self.STEP
+            elif rate < self.last_rate * (1 + self.MARGIN):
+                self.step = 1
+            elif self.step == 1:
+                self.step = self.STEP
+        self.last_rate = rate
+        self.size = self.bounded(self.size * self.step)
+
+
+def row_size(row: tuple) -> int:
+    """ Bytes a fetched row takes up in memory, not counting objects shared with other rows
+    """
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+
+def fetch_batches(curs, batch_size: int, sizer: Optional[BatchSizer] = None) -> Iterator[List[tuple]]:
+    """ Fetch batch_size rows at a time, or as many as the sizer asks for every round
+
+    A round lasts from one fetch to the next, so it includes what the caller did with the batch.
+    """
+    started = perf_counter()
+    while True:
+        size = governed_batch_size(sizer.size if sizer else batch_size)
+        rows = curs.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+        # A short batch is the last one, or one the governor shrank, and says nothing about the size
+        if sizer and len(rows) == size == sizer.size:
+            sizer.observe(rows, perf_counter() - started)
+        started = perf_counter()
+
+
+@contextlib.contextmanager
+def exported_snapshot(db: str):
+    """ Hold a REPEATABLE READ transaction open and yield its exported snapshot id
+    """
+    with connect(db) as (_, curs):
+        curs.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+        curs.execute("SELECT pg_export_snapshot();")
+        yield curs.fetchone()[0]
+
+
+def set_snapshot(curs, snapshot: Optional[str]):
+    """ Make the cursor's transaction see the database as of an exported snapshot
+
+    Has to come before any query in the transaction, and can't go through a named cursor.
+    """
+    if snapshot:
+        curs.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+        curs.execute("SET TRANSACTION SNAPSHOT %s;", (snapshot, ))
+
+
+def enable_passthrough(curs, fetch_curs, src: "Relation", tstz_field: str):
+    """ Have fetch_curs hand out the columns of the relation as the text the server sent, without parsing them
+
+    Their types are looked up through curs. The loaders pass those strings on as they are, as COPY text or
+    as literals the target casts to its column types. tstz_field's type is still parsed, the watermark is
+    compared as a timestamp. The typecaster is registered on the cursor alone, pooled connections don't
+    keep it.
+    """
+    curs.execute("""
+                 SELECT a.attname, a.atttypid::INT, t.typbasetype::INT
+                 FROM pg_attribute a
+                 JOIN pg_type t ON t.oid = a.atttypid
+                 WHERE a.attrelid = format('%%I.%%I', %s, %s)::REGCLASS AND a.attnum > 0 AND NOT a.attisdropped;
+                 """, (src.schema, src.name))
+    # A domain's values are described with the type it's based on
+    types = {name: {oid, base} - {0} for name, oid, base in curs.fetchall()}
+    oids = set().union(*types.values()) - types.get(tstz_field, set())
+    if oids:
+        text = psycopg2.extensions.new_type(tuple(sorted(oids)), "ETL_PASSTHROUGH", lambda value, _: value)
+        psycopg2.extensions.register_type(text, fetch_curs)
 
 
 Column = namedtuple("Column", ("name", "type"))
 Relation = namedtuple("Relation", ("db", "schema", "name"))
+# Run log entries are upserted on this
+LOG_KEY = ("schema_name", "relation_name")
+
+Table = namedtuple("Table", ("source", "target", "key_field", "tstz_field"))
+TableResult = namedtuple("TableResult", ("table", "loaded", "error"))
 
 
+@measured("get_columns")
 def get_columns(rel: Relation):
     columns = []
     with connect(rel.db) as (_, curs):
@@ -56,11 +718,13 @@ def get_columns(rel: Relation):
     return columns
 
 
-def make_sure_table_exists(rel: Relation, columns: List[Column], key):
+def make_sure_table_exists(rel: Relation, columns: List[Column], key, primary_key: Sequence[str] = ()):
     with connect(rel.db) as (_, curs):
-        cols_ddl = ',\n                         '.join(
-            [f'"{col.name}" {col.type}{" UNIQUE" if key==col.name else ""}' for col in columns]
-        )
+        definitions = [f'"{col.name}" {col.type}{" UNIQUE" if key==col.name else ""}' for col in columns]
+        if primary_key:
+            key_list = '", "'.join(primary_key)
+            definitions.append(f'PRIMARY KEY ("{key_list}")')
+        cols_ddl = ',\n                         '.join(definitions)
         curs.execute(f"""
                      CREATE TABLE IF NOT EXISTS "{rel.schema}"."{rel.name}" (
                          {cols_ddl}
@@ -68,7 +732,61 @@ def make_sure_table_exists(rel: Relation, columns: List[Column], key):
                      """)
 
 
-def get_last_uploaded_time(rel: Relation, log: Relation) -> Union[date, None]:
+def make_sure_columns_exist(rel: Relation, columns: List[Column]):
+    """ Add the columns the table doesn't have yet
+
+    ALTER TABLE takes an exclusive lock even when there's nothing to add, so only missing columns get one.
+    """
+    existing = {col.name for col in get_columns(rel)}
+    missing = [col for col in columns if col.name not in existing]
+    if not missing:
+        return
+    with connect(rel.db) as (_, curs):
+        for col in missing:
+            curs.execute(f"""
+                         ALTER TABLE "{rel.schema}"."{rel.name}"
+                         ADD COLUMN IF NOT EXISTS "{col.name}" {col.type};
+                         """)
+
+
+def make_sure_index_exists(rel: Relation, columns: Sequence[str]):
+    column_list = '", "'.join(columns)
+    with connect(rel.db) as (_, curs):
+        curs.execute(f"""
+                     CREATE INDEX IF NOT EXISTS "{rel.name}_{'_'.join(columns)}_idx"
+                     ON "{rel.schema}"."{rel.name}" ("{column_list}");
+                     """)
+
+
+def make_sure_primary_key_exists(rel: Relation, primary_key: Sequence[str], newest: Optional[str] = None):
+    """ Add the primary key to a table created without one, dropping all but one row per key first
+
+    The row kept is the one with the greatest newest column, or an arbitrary one without newest.
+    """
+    key_list = '", "'.join(primary_key)
+    with connect(rel.db) as (_, curs):
+        curs.execute("""
+                     SELECT 1
+                     FROM pg_index
+                     WHERE indrelid = format('%%I.%%I', %s, %s)::REGCLASS AND indisprimary;
+                     """, (rel.schema, rel.name))
+        if curs.fetchone():
+            return
+        matching = " AND ".join(f'a."{col}" = b."{col}"' for col in primary_key)
+        older = "a.ctid < b.ctid"
+        if newest:
+            # NULLs sort first, a row with a value is kept over one without
+            older = (f'(a."{newest}" < b."{newest}" OR (a."{newest}" IS NULL AND b."{newest}" IS NOT NULL) '
+                     f'OR (a."{newest}" IS NOT DISTINCT FROM b."{newest}" AND {older}))')
+        curs.execute(f"""
+                     DELETE FROM "{rel.schema}"."{rel.name}" AS a
+                     USING "{rel.schema}"."{rel.name}" AS b
+                     WHERE {matching} AND {older};
+                     """)
+        curs.execute(f'ALTER TABLE "{rel.schema}"."{rel.name}" ADD PRIMARY KEY ("{key_list}");')
+
+
+def get_last_uploaded_time(rel: Relation, log: Relation) -> Union[datetime, None]:
     with connect(log.db) as (_, curs):
         curs.execute(f"""
                      SELECT loaded
@@ -80,83 +798,1213 @@ def get_last_uploaded_time(rel: Relation, log: Relation) -> Union[date, None]:
             return row[0]
 
 
-def copy(src: Relation, tgt: Relation, key_field: str, tstz_field: str, last_upload: date):
-    with connect(src.db) as (_, curs):
-        # Since the starting date for the extraction can be null, daterange is used as it treats NULL as "no limit"
+def get_checkpoint(rel: Relation, log: Relation) -> Tuple[Optional[datetime], Optional[str]]:
+    """ Watermark and, if a keyset extraction stopped there, the last key copied at that timestamp
+    """
+    with connect(log.db) as (_, curs):
         curs.execute(f"""
-                     SELECT *
+                     SELECT loaded, last_key
+                     FROM "{log.schema}"."{log.name}"
+                     WHERE schema_name=%s AND relation_name=%s;
+                     """, (rel.schema, rel.name))
+        row = curs.fetchone()
+        if row:
+            return row[0], row[1]
+        return None, None
+
+
+def get_checkpoints(rels: Sequence[Relation], log: Relation) -> Dict[Tuple[str, str], Tuple[datetime, Optional[str]]]:
+    """ get_checkpoint() for many relations with a single query, keyed by (schema, name)
+
+    Relations that were never copied are left out.
+    """
+    with connect(log.db) as (_, curs):
+        curs.execute(f"""
+                     SELECT schema_name, relation_name, loaded, last_key
+                     FROM "{log.schema}"."{log.name}"
+                     WHERE (schema_name, relation_name) IN (
+                        SELECT * FROM unnest(%s::TEXT[], %s::TEXT[])
+                     );
+                     """, ([rel.schema for rel in rels], [rel.name for rel in rels]))
+        return {(schema, name): (loaded, last_key) for schema, name, loaded, last_key in curs.fetchall()}
+
+
+def incremental_filter(tstz_field: str, last_upload: Optional[datetime]) -> Tuple[str, tuple]:
+    """ WHERE condition selecting rows since the watermark, everything if there is none yet
+
+    A plain comparison on the column lets the planner use a btree index on it.
+    """
+    if last_upload is None:
+        return "TRUE", ()
+    return f'"{tstz_field}" >= %s', (last_upload, )
+
+
+def extraction_query(src: Relation, tstz_field: str, last_upload: Optional[datetime],
+                     columns: str = "*", where: Optional[Tuple[str, tuple]] = None) -> Tuple[str, tuple]:
+    """ SELECT for the incremental slice, where is an optional extra condition and its parameters
+    """
+    condition, params = incremental_filter(tstz_field, last_upload)
+    if where:
+        condition, params = f"{condition} AND ({where[0]})", params + where[1]
+    return f"""
+                     SELECT {columns}
                      FROM "{src.schema}"."{src.name}"
-                     WHERE "{tstz_field}" <@ DATERANGE(%s::DATE, NULL, '[)');
-                     """, (last_upload, ))
+                     WHERE {condition}""", params
+
+
+def keyset_filter(tstz_field: str, key_field: str, last_upload: Optional[datetime],
+                  last_key: Optional[str]) -> Tuple[str, tuple]:
+    """ WHERE condition for the keyset page following the (last_upload, last_key) position
+
+    Rows without a timestamp can't be paged through and are left out.
+    """
+    if last_upload is None:
+        return f'"{tstz_field}" IS NOT NULL', ()
+    if last_key is None:
+        return f'"{tstz_field}" >= %s', (last_upload, )
+    return f'("{tstz_field}", "{key_field}") > (%s, %s)', (last_upload, last_key)
 
-        columns = '", "'.join(desc[0] for desc in curs.description)
-        placeholders = ', '.join(['%s'] * len(curs.description))
 
-        insert_query = f"""
+def estimate_row_bytes(src: Relation) -> Optional[int]:
+    """ Bytes a row of the relation takes up once fetched, from the planner's average column widths
+
+    Every value becomes a Python object with its own overhead on top of its width. Returns None without
+    statistics on the relation.
+    """
+    with connect(src.db) as (_, curs):
+        curs.execute("""
+                     SELECT sum(avg_width), count(*)
+                     FROM pg_stats
+                     WHERE schemaname=%s AND tablename=%s;
+                     """, (src.schema, src.name))
+        width, columns = curs.fetchone()
+    if not columns:
+        return None
+    return sys.getsizeof(()) + columns * (8 + sys.getsizeof("")) + int(width)
+
+
+def batch_sizer(src: Relation, batch_size: Optional[int], adaptive_batches: bool,
+                batch_memory: int) -> Optional[BatchSizer]:
+    """ BatchSizer for copying from the relation, None when batches aren't adaptive
+    """
+    if not adaptive_batches or not batch_size:
+        return None
+    row_bytes = estimate_row_bytes(src)
+    return BatchSizer(batch_size, row_bytes or batch_memory // batch_size, batch_memory)
+
+
+def key_split_points(src: Relation, key_field: str, partitions: int) -> List[Any]:
+    """ Keys that split the table into partitions ranges of about the same number of rows
+
+    The planner statistics' histogram is used when there is one, otherwise the range between the
+    smallest and largest key is cut into equal parts, which only works for numeric keys.
+    """
+    with connect(src.db) as (_, curs):
+        curs.execute("""
+                     SELECT histogram_bounds::TEXT::TEXT[]
+                     FROM pg_stats
+                     WHERE schemaname=%s AND tablename=%s AND attname=%s;
+                     """, (src.schema, src.name, key_field))
+        row = curs.fetchone()
+        if row and row[0] and len(row[0]) > partitions:
+            bounds = row[0]
+            points = [bounds[len(bounds) * i // partitions] for i in range(1, partitions)]
+            return list(dict.fromkeys(points))
+
+        curs.execute(f'SELECT min("{key_field}"), max("{key_field}") FROM "{src.schema}"."{src.name}";')
+        low, high = curs.fetchone()
+    if not isinstance(low, int) or not isinstance(high, int):
+        warnings.warn(f'No statistics on "{src.name}"."{key_field}" to split it by, ANALYZE the source',
+                      RuntimeWarning)
+        return []
+    return list(dict.fromkeys(low + (high - low) * i // partitions for i in range(1, partitions)))
+
+
+def key_range_filters(key_field: str, points: List[Any]) -> List[Tuple[str, tuple]]:
+    """ Conditions for the ranges between the split points, together they cover every row
+    """
+    if not points:
+        return [("TRUE", ())]
+    filters = [(f'"{key_field}" < %s OR "{key_field}" IS NULL', (points[0], ))]
+    for low, high in zip(points, points[1:]):
+        filters.append((f'"{key_field}" >= %s AND "{key_field}" < %s', (low, high)))
+    filters.append((f'"{key_field}" >= %s', (points[-1], )))
+    return filters
+
+
+def block_range_filters(src: Relation, partitions: int) -> Optional[List[Tuple[str, tuple]]]:
+    """ Conditions splitting the table's heap into partitions ranges of blocks
+
+    Each range is read with a TID range scan, which doesn't depend on how the keys are distributed.
+    Returns None when the source is older than PostgreSQL 14 and can't do those scans.
+    """
+    with connect(src.db) as (conn, curs):
+        if conn.server_version < 140000:
+            return None
+        curs.execute("""
+                     SELECT pg_relation_size(format('%%I.%%I', %s, %s)::REGCLASS)
+                        / current_setting('block_size')::BIGINT;
+                     """, (src.schema, src.name))
+        blocks = curs.fetchone()[0]
+
+    points = list(dict.fromkeys(f"({blocks * i // partitions},0)" for i in range(1, partitions)))
+    if not blocks or not points:
+        return [("TRUE", ())]
+    # The last range is left open for pages added while copying
+    filters = [("ctid < %s::TID", (points[0], ))]
+    for low, high in zip(points, points[1:]):
+        filters.append(("ctid >= %s::TID AND ctid < %s::TID", (low, high)))
+    filters.append(("ctid >= %s::TID", (points[-1], )))
+    return filters
+
+
+def plan_nodes(plan: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def check_extraction_plan(src: Relation, tstz_field: str, last_upload: Optional[datetime]) -> bool:
+    """ EXPLAIN the incremental extraction and warn if it scans the whole source table
+
+    Returns False when a sequential scan was planned. Without a watermark everything is read anyway,
+    so there's nothing to check.
+    """
+    if last_upload is None:
+        return True
+    query, params = extraction_query(src, tstz_field, last_upload)
+    with connect(src.db) as (_, curs):
+        curs.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+        plan = curs.fetchone()[0][0]["Plan"]
+
+    seq_scans = [node for node in plan_nodes(plan)
+                 if node["Node Type"] == "Seq Scan" and node.get("Relation Name") == src.name]
+    if seq_scans:
+        warnings.warn(f'Extracting "{src.schema}"."{src.name}" since {last_upload} scans the whole table, '
+                      f'consider an index on "{tstz_field}"', RuntimeWarning)
+        return False
+    return True
+
+
+def text_literal(value) -> str:
+    """ PostgreSQL text input representation of an adapted Python value
+    """
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (bytes, memoryview)):
+        return "\\x" + bytes(value).hex()
+    if isinstance(value, (list, tuple)):
+        return array_literal(value)
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if isinstance(value, timedelta):
+        # Days stay days, and the seconds never come out in scientific notation
+        return f"{value.days} days {value.seconds}.{value.microseconds:06d} seconds"
+    return str(value)
+
+
+def array_literal(values) -> str:
+    items = []
+    for value in values:
+        if value is None:
+            items.append("NULL")
+        elif isinstance(value, (list, tuple)):
+            items.append(array_literal(value))
+        else:
+            text = text_literal(value).replace("\\", "\\\\").replace('"', '\\"')
+            items.append(f'"{text}"')
+    return "{" + ",".join(items) + "}"
+
+
+def encode_copy_rows(rows: List[tuple], description) -> io.BytesIO:
+    """ Serialize fetched rows into COPY text format
+    """
+    json_columns = [desc[1] in JSON_OIDS for desc in description]
+    lines = []
+    for row in rows:
+        fields = []
+        for value, is_json in zip(row, json_columns):
+            if value is None:
+                fields.append("\\N")
+                continue
+            if is_json and not isinstance(value, str):
+                value = json.dumps(value)
+            fields.append(text_literal(value).translate(COPY_ESCAPES))
+        lines.append("\t".join(fields))
+    lines.append("")
+    return io.BytesIO("\n".join(lines).encode())
+
+
+def create_staging_table(curs, tgt: Relation, staging: str = "temporary") -> str:
+    """ Table shaped like the target to bulk load into before merging
+
+    A temporary table is dropped when the load commits, an unlogged one is kept next to the target
+    and emptied before use. Neither writes WAL for the staged rows.
+    """
+    if staging == "temporary":
+        name = f'"etl_staging_{tgt.name}"'
+        curs.execute(f"""
+                     CREATE TEMPORARY TABLE {name}
+                     (LIKE "{tgt.schema}"."{tgt.name}" INCLUDING DEFAULTS)
+                     ON COMMIT DROP;
+                     """)
+    elif staging == "unlogged":
+        name = f'"{tgt.schema}"."etl_staging_{tgt.name}"'
+        curs.execute(f"""
+                     CREATE UNLOGGED TABLE IF NOT EXISTS {name}
+                     (LIKE "{tgt.schema}"."{tgt.name}" INCLUDING DEFAULTS);
+                     TRUNCATE {name};
+                     """)
+    else:
+        raise ValueError(f"Unknown staging table kind {staging!r}, expected temporary or unlogged")
+    return name
+
+
+def merge_staging(curs, staging: str, tgt: Relation, columns: List[str], key_field: str, use_merge: bool = False):
+    """ Move staged rows into the target with one set-based statement, skipping keys that already exist
+
+    Returns the number of rows inserted.
+    """
+    column_list = '", "'.join(columns)
+    if use_merge:
+        if curs.connection.server_version < 150000:
+            raise ValueError("MERGE needs PostgreSQL 15 or newer on the target")
+        values = ", ".join(f's."{col}"' for col in columns)
+        # Unlike ON CONFLICT, MERGE fails on duplicate keys within its own input
+        curs.execute(f"""
+                     MERGE INTO "{tgt.schema}"."{tgt.name}" AS t
+                     USING (
+                        SELECT DISTINCT ON ("{key_field}") "{column_list}"
+                        FROM {staging}
+                     ) AS s
+                     ON t."{key_field}" = s."{key_field}"
+                     WHEN NOT MATCHED THEN
+                        INSERT ("{column_list}") VALUES ({values});
+                     """)
+    else:
+        curs.execute(f"""
+                     INSERT INTO "{tgt.schema}"."{tgt.name}"
+                     ("{column_list}")
+                     SELECT "{column_list}"
+                     FROM {staging}
+                     ON CONFLICT ("{key_field}") DO NOTHING;
+                     """)
+    return curs.rowcount
+
+
+def batch_loader(strategy: str, curs, tgt: Relation, description, key_field: str,
+                 staging: str = "temporary", use_merge: bool = False,
+                 page_size: int = 1000, stats: Optional[CopyStats] = None) -> Callable[[List[tuple]], None]:
+    """ Function that writes one batch of fetched rows into the target using the given cursor
+
+    The rows it inserts and the bytes it sends are added to stats.
+    """
+    stats = stats if stats is not None else CopyStats()
+    columns = [desc[0] for desc in description]
+    column_list = '", "'.join(columns)
+
+    if strategy == "merge":
+        staging_table = create_staging_table(curs, tgt, staging)
+        stats.round_trips += 1
+
+        def load(rows):
+            data = encode_copy_rows(rows, description)
+            curs.copy_expert(f'COPY {staging_table} ("{column_list}") FROM STDIN', data)
+            stats.add_bytes(data.getbuffer().nbytes)
+            stats.rows_inserted += merge_staging(curs, staging_table, tgt, columns, key_field, use_merge)
+            curs.execute(f"TRUNCATE {staging_table};")
+            stats.round_trips += 3
+        return load
+
+    if strategy == "values":
+        values_query = f"""
         INSERT INTO "{tgt.schema}"."{tgt.name}"
-        ("{columns}")
-        VALUES ({placeholders})
+        ("{column_list}")
+        VALUES %s
         ON CONFLICT ("{key_field}") DO NOTHING;
         """
-        with connect(tgt.db) as (_, tgt_curs):
-            tgt_curs.executemany(insert_query, curs.fetchall())
 
+        def load(rows):
+            # One page at a time, execute_values only leaves the last page's rowcount and query behind
+            for start in range(0, len(rows), page_size):
+                psycopg2.extras.execute_values(curs, values_query, rows[start:start + page_size],
+                                               page_size=page_size)
+                stats.rows_inserted += curs.rowcount
+                stats.add_bytes(len(curs.query))
+                stats.round_trips += 1
+        return load
 
-def log_upload(rel: Relation, log: Relation, last_upload: date):
-    with connect(log.db) as (_, curs):
+    placeholders = ', '.join(['%s'] * len(columns))
+    insert_query = f"""
+    INSERT INTO "{tgt.schema}"."{tgt.name}"
+    ("{column_list}")
+    VALUES ({placeholders})
+    ON CONFLICT ("{key_field}") DO NOTHING;
+    """
+
+    def load(rows):
+        curs.executemany(insert_query, rows)
+        stats.rows_inserted += curs.rowcount
+        stats.round_trips += len(rows)
+    return load
+
+
+def relay_copy(src: Relation, tgt: Relation, key_field: str, tstz_field: str, last_upload: Optional[datetime],
+               staging: str = "temporary", use_merge: bool = False,
+               where: Optional[Tuple[str, tuple]] = None, snapshot: Optional[str] = None,
+               log_watermark: Optional[Callable] = None, stats: Optional[CopyStats] = None) -> Optional[datetime]:
+    """ Stream COPY output of the source straight into COPY input of the target
+
+    Rows are never parsed in Python, the text format is passed through an OS pipe.
+    Returns the latest tstz_field value copied. Both COPYs run at once, their time counts as loading.
+    """
+    stats = stats if stats is not None else CopyStats()
+    columns = [col.name for col in get_columns(tgt)]
+    column_list = '", "'.join(columns)
+
+    with connect(src.db) as (_, src_curs), connect(tgt.db) as (tgt_conn, tgt_curs):
+        set_snapshot(src_curs, snapshot)
+        staging_table = create_staging_table(tgt_curs, tgt, staging)
+
+        select = src_curs.mogrify(*extraction_query(src, tstz_field, last_upload, f'"{column_list}"', where))
+        extract_query = f"COPY ({select.decode()}) TO STDOUT"
+        load_query = f'COPY {staging_table} ("{column_list}") FROM STDIN'
+
+        read_fd, write_fd = os.pipe()
+        reader, writer = CountingReader(os.fdopen(read_fd, "rb")), os.fdopen(write_fd, "wb")
+        errors = []
+
+        def extract():
+            try:
+                src_curs.copy_expert(extract_query, writer)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # EOF for the target's COPY
+                writer.close()
+
+        extractor = threading.Thread(target=extract, name=f"extract-{src.name}", daemon=True)
+        extractor.start()
+        try:
+            with stats.timing("load"):
+                tgt_curs.copy_expert(load_query, reader)
+        finally:
+            # Unblocks the extractor with a broken pipe if the load failed early
+            reader.file.close()
+            extractor.join()
+        if errors:
+            raise errors[0]
+        stats.add_bytes(reader.count)
+
+        with stats.timing("load"):
+            tgt_curs.execute(f'SELECT count(*), max("{tstz_field}") FROM {staging_table};')
+            extracted, loaded = tgt_curs.fetchone()
+            stats.rows_extracted += extracted
+            stats.rows_inserted += merge_staging(tgt_curs, staging_table, tgt, columns, key_field, use_merge)
+        # Staging table, both COPYs, the count and the merge
+        stats.batches += 1
+        stats.round_trips += 5
+        if log_watermark:
+            log_watermark(tgt_curs, loaded)
+        stats.commit(tgt_conn)
+    return loaded
+
+
+def make_sure_foreign_table_exists(src: Relation, tgt_db: str) -> str:
+    """ postgres_fdw foreign table for the source relation in the target database, created on first use
+
+    The foreign server connects with the connection arguments from config.db and the source database
+    name. Returns the qualified name of the foreign table.
+    """
+    server = f"etl_{src.db}"
+    schema = f"etl_{src.db}_{src.schema}"
+    dsn = get_connect_arguments()
+    server_options = {"dbname": src.db}
+    server_options.update({name: str(dsn[name]) for name in ("host", "port") if dsn.get(name)})
+    mapping_options = {name: str(dsn[name]) for name in ("user", "password") if dsn.get(name)}
+
+    with connect(tgt_db) as (_, curs):
+        # Tables copied in parallel would race each other creating the same objects
+        curs.execute("SELECT pg_advisory_xact_lock(hashtext('etl_fdw'));")
+        curs.execute("CREATE EXTENSION IF NOT EXISTS postgres_fdw;")
+        server_clause = ", ".join(f"{name} %s" for name in server_options)
         curs.execute(f"""
-                     DELETE FROM "{log.schema}"."{log.name}"
-                     WHERE schema_name=%s AND relation_name=%s;
-                     """, (rel.schema, rel.name))
+                     CREATE SERVER IF NOT EXISTS "{server}"
+                     FOREIGN DATA WRAPPER postgres_fdw
+                     OPTIONS ({server_clause});
+                     """, tuple(server_options.values()))
+        mapping_clause = ", ".join(f"{name} %s" for name in mapping_options)
+        curs.execute(f"""
+                     CREATE USER MAPPING IF NOT EXISTS FOR CURRENT_USER
+                     SERVER "{server}"
+                     {f"OPTIONS ({mapping_clause})" if mapping_options else ""};
+                     """, tuple(mapping_options.values()))
+        curs.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}";')
+        curs.execute("SELECT to_regclass(format('%%I.%%I', %s, %s));", (schema, src.name))
+        if curs.fetchone()[0] is None:
+            curs.execute(f"""
+                         IMPORT FOREIGN SCHEMA "{src.schema}"
+                         LIMIT TO ("{src.name}")
+                         FROM SERVER "{server}"
+                         INTO "{schema}";
+                         """)
+    return f'"{schema}"."{src.name}"'
+
+
+def pushdown_copy(src: Relation, tgt: Relation, key_field: str, tstz_field: str, last_upload: Optional[datetime],
+                  where: Optional[Tuple[str, tuple]] = None,
+                  log_watermark: Optional[Callable] = None, stats: Optional[CopyStats] = None) -> Optional[datetime]:
+    """ Load the slice with a single INSERT ... SELECT on the target, reading the source through postgres_fdw
+
+    The watermark condition is pushed down to the source. Returns the latest tstz_field value copied.
+    Reading and writing happen in the one statement, its time counts as loading.
+    """
+    stats = stats if stats is not None else CopyStats()
+    foreign_table = make_sure_foreign_table_exists(src, tgt.db)
+    column_list = '", "'.join(col.name for col in get_columns(tgt))
+    condition, params = incremental_filter(tstz_field, last_upload)
+    if where:
+        condition, params = f"{condition} AND ({where[0]})", params + where[1]
+
+    with connect(tgt.db) as (conn, curs):
+        with stats.timing("load"):
+            curs.execute(f"""
+                         WITH extracted AS MATERIALIZED (
+                            SELECT "{column_list}"
+                            FROM {foreign_table}
+                            WHERE {condition}
+                         ), inserted AS (
+                            INSERT INTO "{tgt.schema}"."{tgt.name}"
+                            ("{column_list}")
+                            SELECT "{column_list}"
+                            FROM extracted
+                            ON CONFLICT ("{key_field}") DO NOTHING
+                            RETURNING 1
+                         )
+                         SELECT count(*), (SELECT count(*) FROM inserted), max("{tstz_field}")
+                         FROM extracted;
+                         """, params)
+            extracted, inserted, loaded = curs.fetchone()
+            stats.rows_extracted += extracted
+            stats.rows_inserted += inserted
+            stats.batches += 1
+            stats.round_trips += 1
+        if log_watermark:
+            log_watermark(curs, loaded)
+        stats.commit(conn)
+    return loaded
+
+
+@contextlib.contextmanager
+def extracted_batches(src: Relation, tstz_field: str, last_upload: Optional[datetime],
+                      batch_size: Optional[int], where: Optional[Tuple[str, tuple]] = None,
+                      snapshot: Optional[str] = None, stats: Optional[CopyStats] = None,
+                      adaptive_batches: bool = False, batch_memory: int = 64 * 2 ** 20,
+                      passthrough: bool = False) -> Iterator[Iterator[Tuple[List[tuple], Any]]]:
+    """ Run the extraction query, yields an iterator over the fetched batches, each with the cursor description
+
+    Batches of batch_size rows, or as many as adaptive batches ask for, come through a server side cursor.
+    Without batch_size the whole slice is a single batch. Fetching counts as extraction in stats.
+    """
+    stats = stats if stats is not None else CopyStats()
+    sizer = batch_sizer(src, batch_size, adaptive_batches, batch_memory)
+    with connect(src.db) as (src_conn, curs), contextlib.ExitStack() as stack:
+        set_snapshot(curs, snapshot)
+        query_curs = curs
+        if batch_size:
+            curs = stack.enter_context(server_cursor(src_conn, batch_size))
+        if passthrough:
+            enable_passthrough(query_curs, curs, src, tstz_field)
+        query, params = extraction_query(src, tstz_field, last_upload, where=where)
+        with stats.timing("extract"):
+            curs.execute(f"{query};", params)
+        stats.round_trips += 1
+
+        if batch_size:
+            batches = timed_batches(fetch_batches(curs, batch_size, sizer), stats)
+        else:
+            batches = timed_batches([curs.fetchall()], stats, fetched=False)
+        # A named cursor only gets a description once the first rows arrive
+        yield ((rows, curs.description) for rows in batches)
+
+
+def copy_pipelined(src: Relation, tgt: Relation, key_field: str, tstz_field: str, last_upload: Optional[datetime],
+                   batch_size: int = 10000, strategy: str = "insert", staging: str = "temporary",
+                   use_merge: bool = False, page_size: int = 1000, loaders: int = 1,
+                   queue_depth: int = 4, where: Optional[Tuple[str, tuple]] = None,
+                   snapshot: Optional[str] = None, stats: Optional[CopyStats] = None,
+                   adaptive_batches: bool = False, batch_memory: int = 64 * 2 ** 20,
+                   passthrough: bool = False) -> Optional[datetime]:
+    """ Read the source on this thread and write it to the target on loader threads at the same time
+
+    Fetched batches are handed over through a queue of at most queue_depth batches, which bounds
+    memory and pauses reading while the loaders catch up. Every loader has a target connection
+    of its own. Returns the latest tstz_field value copied.
+    """
+    stats = stats if stats is not None else CopyStats()
+    if staging == "unlogged" and loaders > 1:
+        raise ValueError("Loaders would share the unlogged staging table, use a temporary one")
+
+    pending = queue.Queue(maxsize=queue_depth)
+    failed = threading.Event()
+    errors = []
+    done = object()
+
+    def hand_over(item):
+        while not failed.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    class Abandoned(Exception):
+        """ Raised in the loaders that are left once another one failed, to roll back what they loaded
+        """
+
+    def load_batches(description, loader_stats):
+        try:
+            with connect(tgt.db) as (tgt_conn, tgt_curs):
+                load = batch_loader(strategy, tgt_curs, tgt, description, key_field, staging, use_merge, page_size,
+                                    loader_stats)
+                while True:
+                    # Once a loader failed, nothing's handed over anymore, not even the end
+                    if failed.is_set():
+                        raise Abandoned()
+                    try:
+                        rows = pending.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if rows is done:
+                        break
+                    with loader_stats.timing("load"):
+                        load(rows)
+                loader_stats.commit(tgt_conn)
+        except Abandoned:
+            pass
+        except Exception as e:
+            errors.append(e)
+            failed.set()
+
+    threads = []
+    # A set per loader thread, added up once they're done
+    loader_stats = [CopyStats() for _ in range(loaders)]
+    loaded = None
+    try:
+        with extracted_batches(src, tstz_field, last_upload, batch_size, where, snapshot, stats,
+                               adaptive_batches, batch_memory, passthrough) as batches:
+            for rows, description in batches:
+                if not threads:
+                    tstz_index = [desc[0] for desc in description].index(tstz_field)
+                    threads = [threading.Thread(target=load_batches, args=(description, loader_stats[i]),
+                                                name=f"load-{tgt.name}-{i}", daemon=True)
+                               for i in range(loaders)]
+                    for thread in threads:
+                        thread.start()
+                hand_over(rows)
+                if failed.is_set():
+                    break
+                loaded = latest(loaded, *(row[tstz_index] for row in rows))
+    finally:
+        for _ in threads:
+            hand_over(done)
+        for thread in threads:
+            thread.join()
+        for thread_stats in loader_stats:
+            stats.add(thread_stats)
+    if errors:
+        raise errors[0]
+    return loaded
+
+
+def watermark_logger(tgt: Relation, log: Optional[Relation],
+                     previous: Optional[datetime]) -> Optional[Callable]:
+    """ Callback recording the watermark through the cursor that loaded the data, before it commits
+
+    Returns None when the run log is in another database than the target and can't share its transaction.
+    Nothing is written when no rows were copied, the watermark stays at previous then.
+    """
+    if log is None or log.db != tgt.db:
+        return None
+
+    def log_watermark(curs, copied: Optional[datetime]):
+        if copied is not None:
+            log_upload(tgt, log, latest(previous, copied), curs=curs)
+    return log_watermark
+
+
+def copy(src: Relation, tgt: Relation, key_field: str, tstz_field: str, last_upload: Optional[datetime],
+         batch_size: Optional[int] = None, strategy: str = "insert",
+         staging: str = "temporary", use_merge: bool = False, page_size: int = 1000,
+         loaders: int = 0, queue_depth: int = 4, where: Optional[Tuple[str, tuple]] = None,
+         snapshot: Optional[str] = None, log: Optional[Relation] = None,
+         previous: Optional[datetime] = None, stats: Optional[CopyStats] = None,
+         adaptive_batches: bool = False, batch_memory: int = 64 * 2 ** 20,
+         passthrough: bool = False) -> Optional[datetime]:
+    """ Copy the rows with tstz_field at or after last_upload, returns the latest tstz_field value copied
+
+    where is an optional extra condition on the source rows and its parameters, snapshot an exported
+    snapshot id to read the source as of.
+
+    With a run log, the new watermark, never below previous, is recorded in the transaction that commits
+    the data whenever the log is in the target database and the rows are written by a single connection.
+    Otherwise it's recorded right after.
+
+    Row counts, bytes and the time spent extracting, loading and committing are added to stats.
+    With adaptive_batches, batch_size is where the batch size starts, it's then kept within batch_memory.
+    With passthrough, fetched values are loaded as the text the source sent, see enable_passthrough().
+    The copy and pushdown strategies never bring values into Python and ignore it.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown load strategy {strategy!r}, expected one of {STRATEGIES}")
+    log_watermark = watermark_logger(tgt, log, previous)
+
+    if strategy == "copy":
+        copied = relay_copy(src, tgt, key_field, tstz_field, last_upload, staging=staging, use_merge=use_merge,
+                            where=where, snapshot=snapshot, log_watermark=log_watermark, stats=stats)
+    elif strategy == "pushdown":
+        if snapshot:
+            raise ValueError("The pushdown strategy reads the source through its own sessions, "
+                             "it can't use an exported snapshot")
+        copied = pushdown_copy(src, tgt, key_field, tstz_field, last_upload, where, log_watermark, stats)
+    elif loaders and batch_size:
+        copied = copy_pipelined(src, tgt, key_field, tstz_field, last_upload, batch_size=batch_size,
+                                strategy=strategy, staging=staging, use_merge=use_merge, page_size=page_size,
+                                loaders=loaders, queue_depth=queue_depth, where=where, snapshot=snapshot,
+                                stats=stats, adaptive_batches=adaptive_batches, batch_memory=batch_memory,
+                                passthrough=passthrough)
+        # Every loader commits on its own connection, there's no single transaction to share
+        log_watermark = None
+    else:
+        copied = copy_batches(src, tgt, key_field, tstz_field, last_upload, batch_size=batch_size,
+                              strategy=strategy, staging=staging, use_merge=use_merge, page_size=page_size,
+                              where=where, snapshot=snapshot, log_watermark=log_watermark, stats=stats,
+                              adaptive_batches=adaptive_batches, batch_memory=batch_memory,
+                              passthrough=passthrough)
+
+    if log is not None and log_watermark is None and copied is not None:
+        log_upload(tgt, log, latest(previous, copied))
+    return copied
+
+
+def copy_batches(src: Relation, tgt: Relation, key_field: str, tstz_field: str, last_upload: Optional[datetime],
+                 batch_size: Optional[int] = None, strategy: str = "insert", staging: str = "temporary",
+                 use_merge: bool = False, page_size: int = 1000, where: Optional[Tuple[str, tuple]] = None,
+                 snapshot: Optional[str] = None, log_watermark: Optional[Callable] = None,
+                 stats: Optional[CopyStats] = None, adaptive_batches: bool = False,
+                 batch_memory: int = 64 * 2 ** 20, passthrough: bool = False) -> Optional[datetime]:
+    """ Fetch the slice, all at once or batch_size rows at a time, and write every batch to the target
+
+    Returns the latest tstz_field value copied.
+    """
+    stats = stats if stats is not None else CopyStats()
+    with extracted_batches(src, tstz_field, last_upload, batch_size, where, snapshot, stats,
+                           adaptive_batches, batch_memory, passthrough) as batches:
+        first = next(batches, None)
+        if first is None:
+            return None
+        description = first[1]
+        tstz_index = [desc[0] for desc in description].index(tstz_field)
+        loaded = None
+        with connect(tgt.db) as (tgt_conn, tgt_curs):
+            load = batch_loader(strategy, tgt_curs, tgt, description, key_field, staging, use_merge, page_size,
+                                stats)
+            for rows, _ in itertools.chain([first], batches):
+                with stats.timing("load"):
+                    load(rows)
+                loaded = latest(loaded, *(row[tstz_index] for row in rows))
+            if log_watermark:
+                log_watermark(tgt_curs, loaded)
+            stats.commit(tgt_conn)
+    return loaded
+
+
+def copy_with_stats(*args, **kwargs) -> Tuple[Optional[datetime], CopyStats]:
+    """ copy() returning its stats along with the watermark, for processes that can't fill in the caller's
+    """
+    stats = CopyStats()
+    return copy(*args, stats=stats, **kwargs), stats
+
+
+def copy_partitioned(src: Relation, tgt: Relation, key_field: str, tstz_field: str,
+                     last_upload: Optional[datetime], filters: List[Tuple[str, tuple]],
+                     copy_options: Dict[str, Any], stats: Optional[CopyStats] = None) -> Optional[datetime]:
+    """ copy() every part of the table selected by filters at the same time, each on a process of its own
+
+    Every process opens its own source and target connections. Returns the latest tstz_field value
+    copied once all of them have finished, and raises the first error if any of them failed.
+
+    All parts read the source as of one snapshot, exported here unless copy_options has one already.
+    A row moved or inserted into a part that was already read would otherwise be missed by all of them.
+    """
+    if copy_options.get("staging") == "unlogged" and len(filters) > 1:
+        raise ValueError("Parts would share the unlogged staging table, use a temporary one")
+    # Forking from a threaded process could copy held locks or pooled connections into the child
+    context = multiprocessing.get_context("spawn")
+    with contextlib.ExitStack() as stack:
+        if not copy_options.get("snapshot"):
+            copy_options = dict(copy_options, snapshot=stack.enter_context(exported_snapshot(src.db)))
+        with ProcessPoolExecutor(max_workers=len(filters), mp_context=context) as executor:
+            futures = [executor.submit(copy_with_stats, src, tgt, key_field, tstz_field, last_upload, where=where,
+                                       **copy_options)
+                       for where in filters]
+
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        raise errors[0]
+    if stats is not None:
+        for _, part_stats in (future.result() for future in futures):
+            stats.add(part_stats)
+    return latest(*(future.result()[0] for future in futures))
+
+
+def copy_keyset(src: Relation, tgt: Relation, key_field: str, tstz_field: str, log: Relation,
+                last_upload: Optional[datetime], last_key: Optional[str] = None, batch_size: Optional[int] = 10000,
+                strategy: str = "insert", staging: str = "temporary", use_merge: bool = False,
+                page_size: int = 1000, loaders: int = 0, queue_depth: int = 4,
+                snapshot: Optional[str] = None, stats: Optional[CopyStats] = None,
+                adaptive_batches: bool = False, batch_memory: int = 64 * 2 ** 20,
+                passthrough: bool = False, previous: Optional[datetime] = None) -> Optional[datetime]:
+    """ Copy rows after (last_upload, last_key) in pages ordered by (tstz_field, key_field)
+
+    Each page is read and written in short transactions of its own, so no snapshot is held on the source
+    for the whole transfer. The position after every page is checkpointed in the run log, in the same
+    transaction as the page when the log is in the target database, a restart picks up from there.
+    Pages up to previous, the watermark before a lookback, aren't checkpointed so the log never moves
+    back. Returns the latest tstz_field value copied.
+
+    Pages are written before the next one is read, loaders and queue_depth are accepted for the sake of
+    a common set of copy options but not used. With a snapshot every page still sees the same data.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown load strategy {strategy!r}, expected one of {STRATEGIES}")
+    if strategy in ("copy", "pushdown"):
+        raise ValueError(f"The {strategy} strategy loads the slice with a single statement and can't be paged, "
+                         f"use merge instead")
+    batch_size = batch_size or DEFAULT_SETTINGS["batch_size"]
+    stats = stats if stats is not None else CopyStats()
+    sizer = batch_sizer(src, batch_size, adaptive_batches, batch_memory)
+    loaded = None
+    while True:
+        size = governed_batch_size(sizer.size if sizer else batch_size)
+        started = perf_counter()
+        condition, params = keyset_filter(tstz_field, key_field, last_upload, last_key)
+        with connect(src.db) as (_, curs), stats.timing("extract"):
+            set_snapshot(curs, snapshot)
+            if passthrough:
+                enable_passthrough(curs, curs, src, tstz_field)
+            curs.execute(f"""
+                         SELECT *
+                         FROM "{src.schema}"."{src.name}"
+                         WHERE {condition}
+                         ORDER BY "{tstz_field}", "{key_field}"
+                         LIMIT %s;
+                         """, params + (size, ))
+            rows = curs.fetchall()
+            description = curs.description
+        if not rows:
+            return loaded
+        stats.rows_extracted += len(rows)
+        stats.batches += 1
+        stats.round_trips += 1
+
+        names = [desc[0] for desc in description]
+        last_row = rows[-1]
+        last_upload, last_key = last_row[names.index(tstz_field)], str(last_row[names.index(key_field)])
+        loaded = last_upload
+
+        # Re-reading the lookback window, the checkpoint is already further along
+        checkpoint = previous is None or last_upload > previous
+        with connect(tgt.db) as (tgt_conn, tgt_curs):
+            with stats.timing("load"):
+                batch_loader(strategy, tgt_curs, tgt, description, key_field, staging, use_merge, page_size,
+                             stats)(rows)
+            if checkpoint and log.db == tgt.db:
+                log_upload(tgt, log, last_upload, last_key, curs=tgt_curs)
+            stats.commit(tgt_conn)
+        if checkpoint and log.db != tgt.db:
+            log_upload(tgt, log, last_upload, last_key)
+        if len(rows) < size:
+            return loaded
+        if sizer and size == sizer.size:
+            sizer.observe(rows, perf_counter() - started)
+
+
+def spill_directory(spill_dir: str, tgt: Relation) -> str:
+    return os.path.join(spill_dir, f"{tgt.db}.{tgt.schema}.{tgt.name}")
+
+
+def extract_to_spill(src: Relation, tstz_field: str, last_upload: Optional[datetime], directory: str,
+                     batch_size: Optional[int] = 10000, compression: Optional[str] = None,
+                     where: Optional[Tuple[str, tuple]] = None, snapshot: Optional[str] = None,
+                     stats: Optional[CopyStats] = None, adaptive_batches: bool = False,
+                     batch_memory: int = 64 * 2 ** 20, passthrough: bool = False) -> Optional[datetime]:
+    """ Fetch the slice batch_size rows at a time into a new spill in directory, replacing any spill there
+
+    Every batch is kept as COPY text along with its latest tstz_field value. The spill only gets its
+    manifest once the last batch is written, and is removed if extraction fails. Returns the latest
+    tstz_field value extracted.
+    """
+    batch_size = batch_size or DEFAULT_SETTINGS["batch_size"]
+    stats = stats if stats is not None else CopyStats()
+    spill.discard(directory)
+    writer = spill.SpillWriter(directory, compression, source=list(src),
+                               since=last_upload.isoformat() if last_upload is not None else None)
+    extracted = None
+    try:
+        with extracted_batches(src, tstz_field, last_upload, batch_size, where, snapshot, stats,
+                               adaptive_batches, batch_memory, passthrough) as batches:
+            for rows, description in batches:
+                names = [desc[0] for desc in description]
+                writer.manifest["columns"] = names
+                watermark = latest(*(row[names.index(tstz_field)] for row in rows))
+                with stats.timing("extract"):
+                    writer.write(encode_copy_rows(rows, description).getvalue(), len(rows),
+                                 watermark.isoformat() if watermark is not None else None)
+                extracted = latest(extracted, watermark)
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    return extracted
+
+
+def load_spill(directory: str, tgt: Relation, key_field: str, log: Optional[Relation] = None,
+               previous: Optional[datetime] = None, staging: str = "temporary", use_merge: bool = False,
+               stats: Optional[CopyStats] = None) -> Optional[datetime]:
+    """ Replay a complete spill into the target, resuming after the last batch that was loaded
+
+    Every batch is COPYed into a staging table and merged in a transaction of its own, and counted as
+    loaded once that commits. A batch replayed after a crash between the two is merged again, which
+    skips the rows it already inserted. The watermark goes into the run log with the last batch, and
+    the spill is removed after it. Returns the latest tstz_field value in the spill.
+    """
+    stats = stats if stats is not None else CopyStats()
+    manifest = spill.read_manifest(directory)
+    if manifest is None:
+        raise ValueError(f"No complete spill in {directory}")
+    batches = manifest["batches"]
+    watermarks = [datetime.fromisoformat(batch["watermark"]) for batch in batches if batch["watermark"]]
+    loaded = latest(*watermarks)
+    log_watermark = watermark_logger(tgt, log, previous)
+    columns = manifest.get("columns", [])
+    column_list = '", "'.join(columns)
+
+    # Compressed spills have to be decompressed and unpacked
+    read_batches = spill.mapped_batches if manifest["compression"] is None else spill.read_batches
+    for number, payload in read_batches(directory, manifest, spill.loaded_batches(directory)):
+        stats.rows_extracted += batches[number]["rows"]
+        stats.batches += 1
+        with connect(tgt.db) as (tgt_conn, tgt_curs):
+            with stats.timing("load"):
+                staging_table = create_staging_table(tgt_curs, tgt, staging)
+                with spill.PayloadReader(payload) as reader:
+                    tgt_curs.copy_expert(f'COPY {staging_table} ("{column_list}") FROM STDIN', reader,
+                                         size=spill.READ_SIZE)
+                stats.add_bytes(len(payload))
+                stats.rows_inserted += merge_staging(tgt_curs, staging_table, tgt, columns, key_field, use_merge)
+            stats.round_trips += 3
+            last = number == len(batches) - 1
+            if last and log_watermark:
+                log_watermark(tgt_curs, loaded)
+            stats.commit(tgt_conn)
+        spill.mark_loaded(directory, number + 1)
+
+    if log is not None and log_watermark is None and loaded is not None:
+        log_upload(tgt, log, latest(previous, loaded))
+    spill.discard(directory)
+    return loaded
+
+
+def copy_spilled(src: Relation, tgt: Relation, key_field: str, tstz_field: str, last_upload: Optional[datetime],
+                 directory: str, phase: str = "both", compression: Optional[str] = None,
+                 batch_size: Optional[int] = 10000, strategy: str = "merge", staging: str = "temporary",
+                 use_merge: bool = False, page_size: int = 1000, loaders: int = 0, queue_depth: int = 4,
+                 where: Optional[Tuple[str, tuple]] = None, snapshot: Optional[str] = None,
+                 log: Optional[Relation] = None, previous: Optional[datetime] = None,
+                 stats: Optional[CopyStats] = None, adaptive_batches: bool = False,
+                 batch_memory: int = 64 * 2 ** 20, passthrough: bool = False) -> Optional[datetime]:
+    """ copy() by way of a spill in directory, the extract and load phases can run apart
+
+    A spill that's left from an earlier run is loaded, or its load resumed, without reading the source,
+    extraction picks up from the watermark it leaves behind on the next run. The extract phase replaces
+    a spill that's still there, the watermark only moves once one is loaded so the new one covers its
+    rows. Returns the latest tstz_field value loaded, None when nothing was.
+
+    Batches are always loaded through a staging table, strategy, page_size, loaders and queue_depth are
+    accepted for the sake of a common set of copy options but not used.
+    """
+    if phase not in SPILL_PHASES:
+        raise ValueError(f"Unknown spill phase {phase!r}, expected one of {SPILL_PHASES}")
+    stats = stats if stats is not None else CopyStats()
+    if phase != "extract" and spill.read_manifest(directory) is not None:
+        print(f"Loading {tgt.name} spilled to {directory}")
+        return load_spill(directory, tgt, key_field, log, previous, staging, use_merge, stats)
+    if phase == "load":
+        return None
+
+    extract_stats = CopyStats()
+    extract_to_spill(src, tstz_field, last_upload, directory, batch_size, compression, where, snapshot,
+                     extract_stats, adaptive_batches, batch_memory, passthrough)
+    if phase == "extract":
+        stats.add(extract_stats)
+        return None
+    # The rows are counted once more as they're loaded from the spill
+    extract_stats.rows_extracted = extract_stats.batches = 0
+    stats.add(extract_stats)
+    return load_spill(directory, tgt, key_field, log, previous, staging, use_merge, stats)
+
+
+@measured("log_upload")
+def log_upload(rel: Relation, log: Relation, last_upload: Optional[datetime], last_key: Optional[str] = None,
+               curs=None):
+    """ Record the watermark, through curs to make it part of that cursor's transaction
+    """
+    with contextlib.ExitStack() as stack:
+        if curs is None:
+            _, curs = stack.enter_context(connect(log.db))
         curs.execute(f"""
                      INSERT INTO "{log.schema}"."{log.name}"
-                     (schema_name, relation_name, loaded)
+                     (schema_name, relation_name, loaded, last_key)
                      VALUES
-                     (%s, %s, %s);
-                     """, (rel.schema, rel.name, last_upload))
+                     (%s, %s, %s, %s)
+                     ON CONFLICT (schema_name, relation_name) DO UPDATE
+                     SET loaded = EXCLUDED.loaded, last_key = EXCLUDED.last_key;
+                     """, (rel.schema, rel.name, last_upload, last_key))
 
 
-def main():
+def record_run(history: Relation, run_id: str, rel: Relation, started: datetime,
+               watermark_before: Optional[datetime], watermark_after: Optional[datetime],
+               stats: CopyStats, error: Optional[BaseException] = None):
+    """ Append one table's copy to the run history
+    """
+    with connect(history.db) as (_, curs):
+        curs.execute(f"""
+                     INSERT INTO "{history.schema}"."{history.name}"
+                     (run_id, schema_name, relation_name, started, finished, watermark_before, watermark_after,
+                      rows_extracted, rows_inserted, rows_skipped, bytes_sent,
+                      extract_seconds, load_seconds, commit_seconds, error)
+                     VALUES
+                     (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+                     """, (run_id, rel.schema, rel.name, started, datetime.now(timezone.utc),
+                           watermark_before, watermark_after,
+                           stats.rows_extracted, stats.rows_inserted, stats.rows_skipped, stats.bytes_sent,
+                           stats.extract_seconds, stats.load_seconds, stats.commit_seconds,
+                           None if error is None else repr(error)))
+
+
+def copy_table(table: Table, log: Relation, copy_options: Dict[str, Any], preflight: bool = False,
+               lookback: timedelta = timedelta(0), extraction: str = "select",
+               partitions: int = 0, snapshots: Optional[Dict[str, str]] = None,
+               checkpoints: Optional[Dict[Tuple[str, str], Tuple[datetime, Optional[str]]]] = None,
+               history: Optional[Relation] = None, run_id: Optional[str] = None,
+               spill_dir: Optional[str] = None, spill_phase: str = "both",
+               spill_compression: Optional[str] = None) -> Optional[datetime]:
+    """ Incremental load of one table: read its watermark, copy what's new and record the new watermark
+
+    The watermark is the latest tstz_field value that was copied, so the next run starts right where
+    this one stopped, minus the lookback. snapshots maps source databases to exported snapshot ids.
+    checkpoints are the run log entries from get_checkpoints(), the watermark is looked up when not given.
+    With a history relation, what the copy did is appended to it under run_id, whether it succeeded or not.
+    With a spill_dir, the table is copied through a spill in there by copy_spilled(), in spill_phase.
+    """
+    if extraction not in EXTRACTIONS:
+        raise ValueError(f"Unknown extraction {extraction!r}, expected one of {EXTRACTIONS}")
+    if snapshots and table.source.db in snapshots:
+        copy_options = dict(copy_options, snapshot=snapshots[table.source.db])
+    if checkpoints is not None:
+        last_upload, last_key = checkpoints.get((table.target.schema, table.target.name), (None, None))
+    elif extraction == "keyset":
+        last_upload, last_key = get_checkpoint(table.target, log)
+    else:
+        last_upload, last_key = get_last_uploaded_time(table.target, log), None
+
+    stats = CopyStats()
+    started, clock = datetime.now(timezone.utc), perf_counter()
+    previous, loaded, error = last_upload, last_upload, None
+    try:
+        if extraction == "keyset":
+            if lookback and last_upload is not None:
+                last_upload, last_key = last_upload - lookback, None
+                copy_options = dict(copy_options, previous=previous)
+            if spill_dir:
+                warnings.warn(f"{table.target.name} is paged through with a keyset, spill_dir is ignored",
+                              RuntimeWarning)
+            print(f"Paging through {table.source.name} data after {last_upload}, {last_key}")
+            copied = copy_keyset(table.source, table.target, table.key_field, table.tstz_field, log,
+                                 last_upload, last_key, stats=stats, **copy_options)
+            loaded = latest(previous, copied)
+            return loaded
+
+        since = last_upload - lookback if last_upload is not None else None
+        print(f"Getting {table.source.name} data since {since}")
+        if preflight and not (spill_dir and spill_phase == "load"):
+            check_extraction_plan(table.source, table.tstz_field, since)
+        if spill_dir:
+            # A spill is extracted in one piece and loaded through a staging table
+            if partitions > 1:
+                warnings.warn(f"{table.target.name} is copied through a spill, partitions are ignored",
+                              RuntimeWarning)
+            if copy_options.get("strategy") in ("copy", "pushdown"):
+                warnings.warn(f"{table.target.name} is copied through a spill, which is loaded through a staging "
+                              f"table, the {copy_options['strategy']} strategy is ignored", RuntimeWarning)
+            copied = copy_spilled(table.source, table.target, table.key_field, table.tstz_field, since,
+                                  spill_directory(spill_dir, table.target), spill_phase, spill_compression,
+                                  log=log, previous=last_upload, stats=stats, **copy_options)
+        # A pushdown runs on the target server and isn't split, ctid conditions couldn't be pushed down anyway
+        elif partitions > 1 and copy_options.get("strategy") != "pushdown":
+            filters = None
+            if since is None:
+                filters = block_range_filters(table.source, partitions)
+            if filters is None:
+                filters = key_range_filters(table.key_field,
+                                            key_split_points(table.source, table.key_field, partitions))
+            copied = copy_partitioned(table.source, table.target, table.key_field, table.tstz_field, since,
+                                      filters, copy_options, stats)
+            if copied is not None:
+                log_upload(table.target, log, latest(last_upload, copied))
+        else:
+            copied = copy(table.source, table.target, table.key_field, table.tstz_field, since,
+                          log=log, previous=last_upload, stats=stats, **copy_options)
+        loaded = latest(last_upload, copied)
+        return loaded
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        _metrics.add_copy(table.target, stats, perf_counter() - clock)
+        if history is not None:
+            try:
+                record_run(history, run_id, table.target, started, previous, loaded, stats, error)
+            except Exception as e:
+                warnings.warn(f"Couldn't record the run of {table.target.name} in the history: {e!r}",
+                              RuntimeWarning)
+
+
+def copy_admitted(*args, **kwargs) -> Optional[datetime]:
+    """ copy_table() once the memory governor, if there's one, lets another table start
+    """
+    with _governor.admitted() if _governor else contextlib.nullcontext():
+        return copy_table(*args, **kwargs)
+
+
+def copy_tables(tables: Sequence[Table], log: Relation, copy_options: Dict[str, Any],
+                workers: int = 4, **table_options) -> List[TableResult]:
+    """ Run copy_table() for every table on a thread pool, table_options are passed on to it
+
+    A failing table doesn't stop the others, its exception is reported in its TableResult.
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="etl") as executor:
+        futures = [executor.submit(copy_admitted, table, log, copy_options, **table_options)
+                   for table in tables]
+
+    results = []
+    for table, future in zip(tables, futures):
+        error = future.exception()
+        results.append(TableResult(table, None if error else future.result(), error))
+    return results
+
+
+def run(settings: Dict[str, Any]) -> List[TableResult]:
     log = Relation("target", "public", "etl_runs")
     log_columns = [
         Column("schema_name", "TEXT"),
         Column("relation_name", "TEXT"),
-        Column("loaded", "TIMESTAMPTZ")
+        Column("loaded", "TIMESTAMPTZ"),
+        Column("last_key", "TEXT")
+    ]
+    history = Relation("target", "public", "etl_run_history")
+    history_columns = [
+        Column("run_id", "UUID"),
+        Column("schema_name", "TEXT"),
+        Column("relation_name", "TEXT"),
+        Column("started", "TIMESTAMPTZ"),
+        Column("finished", "TIMESTAMPTZ"),
+        Column("watermark_before", "TIMESTAMPTZ"),
+        Column("watermark_after", "TIMESTAMPTZ"),
+        Column("rows_extracted", "BIGINT"),
+        Column("rows_inserted", "BIGINT"),
+        Column("rows_skipped", "BIGINT"),
+        Column("bytes_sent", "BIGINT"),
+        Column("extract_seconds", "DOUBLE PRECISION"),
+        Column("load_seconds", "DOUBLE PRECISION"),
+        Column("commit_seconds", "DOUBLE PRECISION"),
+        Column("error", "TEXT"),
+    ]
+    tables = [
+        Table(Relation("source", "public", "address"), Relation("target", "public", "address"), "id", "created_at"),
+        Table(Relation("source", "public", "company"), Relation("target", "public", "company"), "company_id", "created_at"),
     ]
 
-    print("Getting source data schema")
-
-    source_address = Relation("source", "public", "address")
-    target_address = Relation("target", "public", "address")
-
-    address_columns = get_columns(source_address)
-
-    source_company = Relation("source", "public", "company")
-    target_company = Relation("target", "public", "company")
+    # Loading spills doesn't touch the source, the target tables were made sure of when they were extracted
+    load_only = settings["spill_dir"] and settings["spill_phase"] == "load"
+    if not load_only:
+        print("Getting source data schema")
 
-    company_columns = get_columns(source_company)
+        columns = [get_columns(table.source) for table in tables]
 
     print("Ensuring schema at destination")
 
-    make_sure_table_exists(target_address, address_columns, "id")
-    make_sure_table_exists(target_company, company_columns, "company_id")
-    make_sure_table_exists(log, log_columns, None)
-    
+    if not load_only:
+        for table, table_columns in zip(tables, columns):
+            make_sure_table_exists(table.target, table_columns, table.key_field)
+    make_sure_table_exists(log, log_columns, None, LOG_KEY)
+    make_sure_columns_exist(log, log_columns)
+    make_sure_primary_key_exists(log, LOG_KEY, "loaded")
+    make_sure_table_exists(history, history_columns, None)
+    make_sure_columns_exist(history, history_columns)
+    # For reports over a time range, of all tables or a single one
+    make_sure_index_exists(history, ("started", ))
+    make_sure_index_exists(history, ("schema_name", "relation_name", "started"))
+
     print("Copying data")
 
-    last_upload = get_last_uploaded_time(target_address, log)
-    print(f"Getting address data since {last_upload}")
-    today = date.today()
-    copy(source_address, target_address, "id", "created_at", last_upload)
-    log_upload(target_address, log, today)
+    copy_options = {name: settings[name] for name in COPY_SETTINGS}
+    with contextlib.ExitStack() as stack:
+        snapshots = {}
+        if settings["consistent_snapshot"] and not load_only:
+            # Without one, tables read in parallel could each see a different state of the source
+            for db in sorted({table.source.db for table in tables}):
+                snapshots[db] = stack.enter_context(exported_snapshot(db))
+        results = copy_tables(tables, log, copy_options, settings["workers"],
+                              preflight=settings["preflight"],
+                              lookback=timedelta(seconds=settings["lookback_seconds"]),
+                              extraction=settings["extraction"],
+                              partitions=settings["partitions"],
+                              snapshots=snapshots,
+                              checkpoints=get_checkpoints([table.target for table in tables], log),
+                              history=history,
+                              run_id=str(uuid.uuid4()),
+                              spill_dir=settings["spill_dir"],
+                              spill_phase=settings["spill_phase"],
+                              spill_compression=settings["spill_compression"])
 
-    last_upload = get_last_uploaded_time(target_company, log)
-    print(f"Getting company data since {last_upload}")
-    today = date.today()
-    copy(source_company, target_company, "company_id", "created_at", last_upload)
-    log_upload(target_company, log, today)
+    for result in results:
+        if result.error:
+            print(f"Failed copying {result.table.source.name}: {result.error!r}")
+        else:
+            print(f"Copied {result.table.source.name} up to {result.loaded}")
 
     print("Done")
+    return results
+
+
+def main():
+    settings = get_settings()
+    # Every step below opens its own connect(), the pool turns those into reused sessions
+    enable_pooling(settings["pool_minconn"], settings["pool_maxconn"])
+    if settings["memory_limit"]:
+        enable_memory_governor(settings["memory_limit"])
+    results = None
+    try:
+        results = run(settings)
+    finally:
+        disable_memory_governor()
+        close_pools()
+        write_metrics(results is not None and not any(result.error for result in results),
+                      settings["metrics_textfile"], settings["metrics_summary"])
+    if any(result.error for result in results):
+        sys.exit(1)
 
 
 if __name__=='__main__':
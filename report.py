@@ -0,0 +1,71 @@
+""" Rows/sec per table over time from the run history written by etl.py
+
+Every line sums the runs of one table in one period. The change is against the table's previous period,
+a falling rows/s shows up there first.
+
+    python report.py --days 30 --period week
+"""
+import argparse
+
+import etl
+
+
+def fetch_report(history: etl.Relation, days: int, period: str, relation=None):
+    condition, params = "started >= now() - %s * INTERVAL '1 day'", [days]
+    if relation:
+        condition, params = f"{condition} AND relation_name = %s", params + [relation]
+    with etl.connect(history.db) as (_, curs):
+        curs.execute(f"""
+                     SELECT schema_name,
+                            relation_name,
+                            date_trunc(%s, started) AS period,
+                            count(*),
+                            count(error),
+                            sum(rows_extracted)::BIGINT,
+                            sum(rows_inserted)::BIGINT,
+                            sum(rows_skipped)::BIGINT,
+                            sum(bytes_sent)::BIGINT,
+                            sum(extract_seconds),
+                            sum(load_seconds),
+                            sum(commit_seconds),
+                            sum(extract(EPOCH FROM finished - started))::DOUBLE PRECISION
+                     FROM "{history.schema}"."{history.name}"
+                     WHERE {condition}
+                     GROUP BY schema_name, relation_name, period
+                     ORDER BY schema_name, relation_name, period;
+                     """, [period] + params)
+        return curs.fetchall()
+
+
+def print_report(rows):
+    print(f"{'table':<24} {'period':<16} {'runs':>5} {'failed':>6} {'rows':>12} {'inserted':>12} "
+          f"{'skipped':>10} {'MB':>9} {'extract s':>10} {'load s':>9} {'commit s':>9} {'rows/s':>10} {'change':>7}")
+    previous = {}
+    for (schema, name, period, runs, failed, extracted, inserted, skipped, sent,
+         extract_seconds, load_seconds, commit_seconds, seconds) in rows:
+        rate = extracted / seconds if seconds else None
+        before = previous.get((schema, name))
+        change = f"{(rate - before) / before:+.0%}" if rate is not None and before else ""
+        previous[(schema, name)] = rate
+        megabytes = f"{sent / 1e6:.1f}" if sent is not None else "-"
+        print(f"{schema + '.' + name:<24} {period:%Y-%m-%d %H:%M} {runs:>5} {failed:>6} {extracted:>12,} "
+              f"{inserted:>12,} {skipped:>10,} {megabytes:>9} {extract_seconds:>10.1f} {load_seconds:>9.1f} "
+              f"{commit_seconds:>9.1f} {rate or 0:>10,.0f} {change:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default="target")
+    parser.add_argument("--schema", default="public")
+    parser.add_argument("--history", default="etl_run_history", help="Run history table")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--period", choices=("hour", "day", "week", "month"), default="day")
+    parser.add_argument("--table", help="Only this target table")
+    args = parser.parse_args()
+
+    history = etl.Relation(args.db, args.schema, args.history)
+    print_report(fetch_report(history, args.days, args.period, args.table))
+
+
+if __name__=='__main__':
+    main()
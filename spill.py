@@ -0,0 +1,182 @@
+""" Spill files: extracted batches kept on local disk until they're loaded
+
+A spill is a directory holding one file of msgpack frames, optionally gzip or zstd compressed, a manifest
+and the loading progress. Every frame is an array of the batch number, its row count and its COPY text
+payload. The manifest lists where every frame and its payload start in the uncompressed stream, with the
+batch's row count and watermark, and is only written once extraction is done. The progress file holds
+how many batches have been loaded, so a failed load resumes after the last one that committed.
+
+Uncompressed spills are read back through a memory map, every payload is a view into the page cache
+and only the chunks COPY asks for are copied out of it.
+"""
+import gzip
+import json
+import mmap
+import os
+import shutil
+from typing import Any, BinaryIO, Dict, Iterator, Optional, Tuple
+
+import msgpack
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSIONS = (None, "gzip", "zstd")
+MANIFEST = "manifest.json"
+PROGRESS = "progress.json"
+# Bytes handed to COPY per read() from a payload
+READ_SIZE = 2 ** 20
+
+
+def data_file(compression: Optional[str]) -> str:
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown spill compression {compression!r}, expected one of {COMPRESSIONS}")
+    return {None: "batches.msgpack", "gzip": "batches.msgpack.gz", "zstd": "batches.msgpack.zst"}[compression]
+
+
+def open_stream(path: str, mode: str, compression: Optional[str]) -> BinaryIO:
+    if compression == "gzip":
+        return gzip.open(path, mode, compresslevel=1)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compressed spills need the zstandard package")
+        if mode == "wb":
+            return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, mode)
+
+
+def replace_json(path: str, value: Any):
+    """ Write the JSON next to its final place, sync it and move it there
+    """
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as file:
+        json.dump(value, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+class SpillWriter:
+    """ Appends batches to a new spill, the manifest is written by close()
+    """
+    def __init__(self, directory: str, compression: Optional[str] = None, **metadata):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.manifest = dict(metadata, compression=compression, file=data_file(compression), batches=[])
+        self.file = open_stream(os.path.join(directory, self.manifest["file"]), "wb", compression)
+        self.packer = msgpack.Packer(use_bin_type=True)
+        self.offset = 0
+
+    def write(self, payload: bytes, rows: int, watermark: Optional[str]):
+        frame = self.packer.pack([len(self.manifest["batches"]), rows, payload])
+        self.file.write(frame)
+        self.manifest["batches"].append({
+            "offset": self.offset,
+            "length": len(frame),
+            # The payload is the frame's last item and ends it
+            "payload_offset": self.offset + len(frame) - len(payload),
+            "payload_length": len(payload),
+            "rows": rows,
+            "watermark": watermark,
+        })
+        self.offset += len(frame)
+
+    def close(self):
+        self.file.close()
+        # The batches have to be on disk before a manifest says they're there
+        with open(os.path.join(self.directory, self.manifest["file"]), "rb") as file:
+            os.fsync(file.fileno())
+        replace_json(os.path.join(self.directory, MANIFEST), self.manifest)
+
+    def abort(self):
+        self.file.close()
+        discard(self.directory)
+
+
+def read_manifest(directory: str) -> Optional[Dict[str, Any]]:
+    """ The manifest of a complete spill, None if there's none or its extraction didn't finish
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def read_batches(directory: str, manifest: Dict[str, Any], start: int = 0) -> Iterator[Tuple[int, bytes]]:
+    """ Number and payload of every batch from start on
+    """
+    batches = manifest["batches"]
+    if start >= len(batches):
+        return
+    with open_stream(os.path.join(directory, manifest["file"]), "rb", manifest["compression"]) as stream:
+        # Compressed streams get there by decompressing, but don't unpack what's skipped
+        stream.seek(batches[start]["offset"])
+        largest = max(batch["length"] for batch in batches[start:])
+        for number, _, payload in msgpack.Unpacker(stream, raw=False, max_buffer_size=max(largest, 2 ** 20)):
+            yield number, payload
+
+
+def mapped_batches(directory: str, manifest: Dict[str, Any], start: int = 0) -> Iterator[Tuple[int, memoryview]]:
+    """ Number and payload of every batch from start on, as views into the memory mapped spill
+
+    Only for uncompressed spills. A view is released once the next batch is asked for, and can't be
+    used after that.
+    """
+    batches = manifest["batches"]
+    if start >= len(batches):
+        return
+    with open(os.path.join(directory, manifest["file"]), "rb") as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        for number in range(start, len(batches)):
+            offset = batches[number]["payload_offset"]
+            with view[offset:offset + batches[number]["payload_length"]] as payload:
+                yield number, payload
+
+
+class PayloadReader:
+    """ File-like reader over a payload, for copy_expert()
+
+    psycopg2 only takes bytes from read(), so every call copies out the chunk it asks for, never the
+    whole payload. The view it takes of the payload is released when it's closed.
+    """
+    def __init__(self, payload):
+        self.payload = memoryview(payload)
+        self.position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.payload.release()
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self.payload) if size < 0 else min(len(self.payload), self.position + size)
+        data = self.payload[self.position:end].tobytes()
+        self.position = end
+        return data
+
+
+def loaded_batches(directory: str) -> int:
+    try:
+        with open(os.path.join(directory, PROGRESS)) as file:
+            return json.load(file)["loaded"]
+    except FileNotFoundError:
+        return 0
+
+
+def mark_loaded(directory: str, loaded: int):
+    replace_json(os.path.join(directory, PROGRESS), {"loaded": loaded})
+
+
+def discard(directory: str):
+    shutil.rmtree(directory, ignore_errors=True)
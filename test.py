@@ -1,14 +1,24 @@
+import bench_compare
+from concurrent.futures import ThreadPoolExecutor
 import config
+from datetime import datetime, timedelta, timezone
 import etl
+import json
 import psycopg2
 import pytest
 import re
-from unittest.mock import MagicMock, Mock, PropertyMock, patch, call
+import spill
+import threading
+from unittest.mock import ANY, MagicMock, Mock, PropertyMock, patch, call
+import warnings
 
 
 # Keep it simple, make sure our tests don't rely on a config
 config.db = {}
 
+# mock_connection() replaces etl.connect for good, keep the real one for tests that need it
+real_connect = etl.connect
+
 whitespace_re = re.compile(r'[\s\n\r]+', re.MULTILINE)
 def canonicalize(val):
     """ Remove excess whitespace and use lower case
@@ -21,6 +31,7 @@ def get_mock_cursor():
     cursor.execute=MagicMock()
     cursor.fetchall=MagicMock(return_value=[])
     cursor.close=MagicMock()
+    cursor.rowcount=0
     return cursor
 
 
@@ -42,6 +53,7 @@ def mock_psycopg2():
             raise Exception()
         else:
             connection = Mock()
+            connection.closed = 0
             connection.cursor = MagicMock(return_value=get_mock_cursor())
             connection.close = MagicMock()
             connection.commit = MagicMock()
@@ -143,9 +155,9 @@ def test_get_last_uploaded_time():
 
 def test_copy():
     cursor = get_mock_cursor()
-    type(cursor).description=PropertyMock(return_value=[("foo_column",)])
+    type(cursor).description=PropertyMock(return_value=[("foo_column",), ("mock_tstz_field",)])
     cursor.executemany=MagicMock()
-    data = [("mock_value",)]
+    data = [("mock_value", 2), ("mock_value", 1)]
     cursor.fetchall=MagicMock(return_value=data)
 
     ctx = mock_connection(cursor)
@@ -164,7 +176,7 @@ def test_copy():
     cursor.execute.assert_called_once()
     assert len(cursor.execute.call_args.args) == 2
     assert canonicalize(
-            '''SELECT * FROM "src_sch"."src_rel" WHERE "mock_tstz_field" <@ DATERANGE(%s::DATE, NULL, '[)');'''
+            '''SELECT * FROM "src_sch"."src_rel" WHERE "mock_tstz_field" >= %s;'''
         ) == canonicalize(
             cursor.execute.call_args.args[0]
         )
@@ -175,11 +187,12 @@ def test_copy():
     cursor.executemany.assert_called_once()
     assert len(cursor.executemany.call_args.args) == 2
     assert canonicalize(
-            '''INSERT INTO "tgt_sch"."tgt_rel" ("foo_column") VALUES (%s) ON CONFLICT ("mock_id") DO NOTHING;'''
+            '''INSERT INTO "tgt_sch"."tgt_rel" ("foo_column", "mock_tstz_field") VALUES (%s, %s) ON CONFLICT ("mock_id") DO NOTHING;'''
         ) == canonicalize(
             cursor.executemany.call_args.args[0]
         )
     assert cursor.executemany.call_args.args[1] == data
+    assert result == 2
 
 
 def test_log_upload():
@@ -197,23 +210,1702 @@ def test_log_upload():
     ctx.__enter__.assert_called_once()
 
     etl.connect.assert_called_once_with("test")
-    assert len(cursor.execute.call_args_list) == 2
+    cursor.execute.assert_called_once()
+    assert len(cursor.execute.call_args.args) == 2
+    assert canonicalize(
+            '''INSERT INTO "public"."log_mock" (schema_name, relation_name, loaded, last_key) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (schema_name, relation_name) DO UPDATE
+            SET loaded = EXCLUDED.loaded, last_key = EXCLUDED.last_key;'''
+        ) == canonicalize(
+            cursor.execute.call_args.args[0]
+        )
+    assert cursor.execute.call_args.args[1] == ('bar', 'baz', 'mock_datetime', None)
+
+
+def test_copy_streaming():
+    cursor = get_mock_cursor()
+    cursor.executemany=MagicMock()
+    named_cursor = get_mock_cursor()
+    type(named_cursor).description=PropertyMock(return_value=[("foo_column",), ("mock_tstz_field",)])
+    batches = [[("a", 1), ("b", 3)], [("c", 2)], []]
+    named_cursor.fetchmany=MagicMock(side_effect=batches)
+
+    ctx = mock_connection(cursor)
+    connection = ctx.__enter__.return_value[0]
+    connection.cursor=MagicMock(return_value=named_cursor)
+
+    result = etl.copy(
+        etl.Relation("src", "src_sch", "src_rel"),
+        etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+        "mock_id",
+        "mock_tstz_field",
+        "mock_datetime",
+        batch_size=2
+    )
+
+    assert connection.cursor.call_args.kwargs["name"].startswith("etl_")
+    assert named_cursor.itersize == 2
+    named_cursor.execute.assert_called_once()
+    cursor.execute.assert_not_called()
+    named_cursor.fetchmany.assert_has_calls([call(2), call(2), call(2)])
+    assert cursor.executemany.call_args_list[0].args[1] == batches[0]
+    assert cursor.executemany.call_args_list[1].args[1] == batches[1]
+    assert len(cursor.executemany.call_args_list) == 2
+    named_cursor.close.assert_called_once_with()
+    assert result == 3
+
+
+def test_copy_streaming_empty():
+    cursor = get_mock_cursor()
+    cursor.executemany=MagicMock()
+    named_cursor = get_mock_cursor()
+    named_cursor.fetchmany=MagicMock(return_value=[])
+
+    ctx = mock_connection(cursor)
+    ctx.__enter__.return_value[0].cursor=MagicMock(return_value=named_cursor)
+
+    result = etl.copy(
+        etl.Relation("src", "src_sch", "src_rel"),
+        etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+        "mock_id",
+        "mock_tstz_field",
+        "mock_datetime",
+        batch_size=2
+    )
+
+    assert result is None
+    etl.connect.assert_called_once_with("src")
+    cursor.executemany.assert_not_called()
+
+
+def test_copy_relay():
+    cursor = get_mock_cursor()
+    cursor.fetchall=MagicMock(return_value=[("id", "integer"), ("name", "text")])
+    cursor.fetchone=MagicMock(return_value=[2, "mock_max"])
+    cursor.mogrify=MagicMock(return_value=b"SELECT mock")
+    cursor.rowcount=1
+    loaded = []
+
+    def copy_expert(query, file):
+        if query.endswith("TO STDOUT"):
+            file.write(b"1\tfoo\n2\tbar\n")
+        else:
+            loaded.append(file.read())
+    cursor.copy_expert=MagicMock(side_effect=copy_expert)
+
+    mock_connection(cursor)
+    stats = etl.CopyStats()
+
+    result = etl.copy(
+        etl.Relation("src", "src_sch", "src_rel"),
+        etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+        "mock_id",
+        "mock_tstz_field",
+        "mock_datetime",
+        strategy="copy",
+        stats=stats
+    )
+
+    assert result == "mock_max"
+    assert (stats.rows_extracted, stats.rows_inserted, stats.rows_skipped, stats.bytes_sent) == (2, 1, 1, 12)
+
+    etl.connect.assert_has_calls([call("tgt"), call("src"), call("tgt")], any_order=True)
+    assert cursor.mogrify.call_args.args[1] == ("mock_datetime", )
+    assert '"id", "name"' in cursor.mogrify.call_args.args[0]
+    extract_call, load_call = cursor.copy_expert.call_args_list
+    assert extract_call.args[0] == 'COPY (SELECT mock) TO STDOUT'
+    assert load_call.args[0] == 'COPY "etl_staging_tgt_rel" ("id", "name") FROM STDIN'
+    assert loaded == [b"1\tfoo\n2\tbar\n"]
+
+    create_call, max_call, merge_call = [c for c in cursor.execute.call_args_list if len(c.args) == 1]
+    assert max_call.args[0] == 'SELECT count(*), max("mock_tstz_field") FROM "etl_staging_tgt_rel";'
+    assert canonicalize(
+            '''CREATE TEMPORARY TABLE "etl_staging_tgt_rel" (LIKE "tgt_sch"."tgt_rel" INCLUDING DEFAULTS) ON COMMIT DROP;'''
+        ) == canonicalize(
+            create_call.args[0]
+        )
+    assert canonicalize(
+            '''INSERT INTO "tgt_sch"."tgt_rel" ("id", "name") SELECT "id", "name" FROM "etl_staging_tgt_rel" ON CONFLICT ("mock_id") DO NOTHING;'''
+        ) == canonicalize(
+            merge_call.args[0]
+        )
+
+
+def test_copy_relay_extract_error():
+    cursor = get_mock_cursor()
+    cursor.fetchall=MagicMock(return_value=[("id", "integer")])
+    cursor.mogrify=MagicMock(return_value=b"SELECT mock")
+
+    def copy_expert(query, file):
+        if query.endswith("TO STDOUT"):
+            raise psycopg2.OperationalError("source went away")
+        file.read()
+    cursor.copy_expert=MagicMock(side_effect=copy_expert)
+
+    ctx = mock_connection(cursor)
+    ctx.__exit__.return_value = False
+
+    with pytest.raises(psycopg2.OperationalError):
+        etl.copy(
+            etl.Relation("src", "src_sch", "src_rel"),
+            etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+            "mock_id",
+            "mock_tstz_field",
+            "mock_datetime",
+            strategy="copy"
+        )
+    assert not any("INSERT" in c.args[0] for c in cursor.execute.call_args_list)
+
+
+def test_copy_unknown_strategy():
+    with pytest.raises(ValueError):
+        etl.copy(
+            etl.Relation("src", "src_sch", "src_rel"),
+            etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+            "mock_id",
+            "mock_tstz_field",
+            "mock_datetime",
+            strategy="carrier_pigeon"
+        )
+
+
+def test_encode_copy_rows():
+    description = [("id", 23), ("name", 25), ("doc", 3802), ("tags", 1009), ("raw", 17), ("flag", 16), ("ts", 1184)]
+    rows = [
+        (1, "tab\there\\", {"a": 1}, ["x", None, 'q"'], b"\x00\xff", True,
+         datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc)),
+        (2, None, None, None, None, False, None),
+    ]
+
+    result = etl.encode_copy_rows(rows, description).getvalue().decode()
+
+    assert result == (
+        '1\ttab\\there\\\\\t{"a": 1}\t{"x",NULL,"q\\\\""}\t\\\\x00ff\tt\t2020-01-02T03:04:05+00:00\n'
+        '2\t\\N\t\\N\t\\N\t\\N\tf\t\\N\n'
+    )
+
+
+@pytest.mark.parametrize("value, literal",
+                         [
+                             (timedelta(microseconds=1), "0 days 0.000001 seconds"),
+                             (timedelta(days=1), "1 days 0.000000 seconds"),
+                             (timedelta(days=-1, seconds=86399, microseconds=500000), "-1 days 86399.500000 seconds"),
+                         ])
+def test_text_literal_interval(value, literal):
+    assert etl.text_literal(value) == literal
+
+
+def test_copy_merge():
+    cursor = get_mock_cursor()
+    cursor.copy_expert=MagicMock()
+    description = [("id", 23), ("name", 25), ("mock_tstz_field", 23)]
+    type(cursor).description=PropertyMock(return_value=description)
+    cursor.fetchall=MagicMock(return_value=[(1, "foo", 10), (2, "bar", 20)])
+
+    mock_connection(cursor)
+
+    etl.copy(
+        etl.Relation("src", "src_sch", "src_rel"),
+        etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+        "id",
+        "mock_tstz_field",
+        "mock_datetime",
+        strategy="merge",
+        staging="unlogged"
+    )
+
+    cursor.copy_expert.assert_called_once()
+    assert cursor.copy_expert.call_args.args[0] == \
+        'COPY "tgt_sch"."etl_staging_tgt_rel" ("id", "name", "mock_tstz_field") FROM STDIN'
+    assert cursor.copy_expert.call_args.args[1].getvalue() == b"1\tfoo\t10\n2\tbar\t20\n"
+
+    _, create_call, merge_call, truncate_call = cursor.execute.call_args_list
+    assert canonicalize(
+            '''CREATE UNLOGGED TABLE IF NOT EXISTS "tgt_sch"."etl_staging_tgt_rel" (LIKE "tgt_sch"."tgt_rel" INCLUDING DEFAULTS);
+            TRUNCATE "tgt_sch"."etl_staging_tgt_rel";'''
+        ) == canonicalize(
+            create_call.args[0]
+        )
+    assert canonicalize(
+            '''INSERT INTO "tgt_sch"."tgt_rel" ("id", "name", "mock_tstz_field")
+            SELECT "id", "name", "mock_tstz_field" FROM "tgt_sch"."etl_staging_tgt_rel"
+            ON CONFLICT ("id") DO NOTHING;'''
+        ) == canonicalize(
+            merge_call.args[0]
+        )
+    assert canonicalize(truncate_call.args[0]) == canonicalize('TRUNCATE "tgt_sch"."etl_staging_tgt_rel";')
+
+
+@pytest.mark.parametrize("server_version, error", [(150004, False), (140010, True)])
+def test_merge_staging_merge_command(server_version, error):
+    cursor = get_mock_cursor()
+    cursor.connection.server_version = server_version
+
+    args = (cursor, '"etl_staging_t"', etl.Relation("tgt", "s", "t"), ["id", "name"], "id", True)
+    if error:
+        with pytest.raises(ValueError):
+            etl.merge_staging(*args)
+        cursor.execute.assert_not_called()
+    else:
+        etl.merge_staging(*args)
+        assert canonicalize(
+                '''MERGE INTO "s"."t" AS t
+                USING ( SELECT DISTINCT ON ("id") "id", "name" FROM "etl_staging_t" ) AS s
+                ON t."id" = s."id"
+                WHEN NOT MATCHED THEN INSERT ("id", "name") VALUES (s."id", s."name");'''
+            ) == canonicalize(
+                cursor.execute.call_args.args[0]
+            )
+
+
+def test_copy_values():
+    cursor = get_mock_cursor()
+    type(cursor).description=PropertyMock(return_value=[("foo_column",), ("mock_tstz_field",)])
+    data = [("mock_value", 1)]
+    cursor.fetchall=MagicMock(return_value=data)
+
+    mock_connection(cursor)
+
+    with patch("psycopg2.extras.execute_values") as execute_values:
+        etl.copy(
+            etl.Relation("src", "src_sch", "src_rel"),
+            etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+            "mock_id",
+            "mock_tstz_field",
+            "mock_datetime",
+            strategy="values",
+            page_size=500
+        )
+
+    execute_values.assert_called_once()
+    assert execute_values.call_args.args[0] is cursor
+    assert canonicalize(
+            '''INSERT INTO "tgt_sch"."tgt_rel" ("foo_column", "mock_tstz_field") VALUES %s ON CONFLICT ("mock_id") DO NOTHING;'''
+        ) == canonicalize(
+            execute_values.call_args.args[1]
+        )
+    assert execute_values.call_args.args[2] == data
+    assert execute_values.call_args.kwargs == {"page_size": 500}
+
+
+def test_connect_pooled(mock_psycopg2):
+    def conn(**kwargs):
+        connection = Mock()
+        connection.cursor = MagicMock(side_effect=get_mock_cursor)
+        connection.closed = 0
+        connection.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        return connection
+    mock_psycopg2.connect.side_effect = conn
+
+    etl.enable_pooling(1, 2)
+    try:
+        with patch.object(etl, "connect", real_connect):
+            with etl.connect("test") as (first, curs):
+                curs.close.assert_not_called()
+            with etl.connect("test") as (second, _):
+                pass
+            with etl.connect("other") as (third, _):
+                pass
+            curs.close.assert_called_once_with()
+    finally:
+        etl.close_pools()
+
+    assert first is second
+    assert third is not first
+    mock_psycopg2.connect.assert_has_calls([call(dbname="test"), call(dbname="other")])
+    assert mock_psycopg2.connect.call_count == 2
+    first.commit.assert_has_calls([call(), call()])
+    first.close.assert_called_once_with()
+    assert etl.get_pool("test") is None
+
+
+def test_connect_pool_waits_for_free_connection(mock_psycopg2):
+    def conn(**kwargs):
+        connection = Mock()
+        connection.closed = 0
+        connection.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        return connection
+    mock_psycopg2.connect.side_effect = conn
+
+    etl.enable_pooling(1, 1)
+    try:
+        with patch.object(etl, "connect", real_connect):
+            acquired = threading.Event()
+
+            def second_user():
+                with etl.connect("test"):
+                    acquired.set()
+
+            with etl.connect("test"):
+                worker = threading.Thread(target=second_user)
+                worker.start()
+                assert not acquired.wait(0.1)
+            worker.join(1)
+            assert acquired.is_set()
+    finally:
+        etl.close_pools()
+    assert mock_psycopg2.connect.call_count == 1
+
+
+def test_connect_pooled_failing_commit(mock_psycopg2):
+    def conn(**kwargs):
+        connection = Mock()
+        connection.closed = 0
+        connection.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        return connection
+    mock_psycopg2.connect.side_effect = conn
+
+    def drop(connection):
+        connection.closed = 2
+        raise psycopg2.InterfaceError("connection already closed")
+
+    etl.enable_pooling(1, 1)
+    try:
+        with patch.object(etl, "connect", real_connect):
+            with pytest.raises(psycopg2.InterfaceError):
+                with etl.connect("test") as (first, curs):
+                    first.commit.side_effect = lambda: drop(first)
+            curs.close.assert_called_once_with()
+            first.close.assert_called_once_with()
+
+            # The slot was given back, the next block gets a new connection
+            acquired = threading.Event()
+
+            def next_user():
+                with etl.connect("test") as (second, _):
+                    acquired.set()
+            worker = threading.Thread(target=next_user, daemon=True)
+            worker.start()
+            worker.join(1)
+            assert acquired.is_set()
+    finally:
+        etl.close_pools()
+    assert mock_psycopg2.connect.call_count == 2
+
+
+def test_connect_rolls_back_on_error(mock_psycopg2):
+    with patch.object(etl, "connect", real_connect), pytest.raises(ValueError):
+        with etl.connect("test") as (conn, curs):
+            conn.rollback.side_effect = psycopg2.OperationalError("mock")
+            raise ValueError("mock")
+    conn.commit.assert_not_called()
+    conn.rollback.assert_called_once_with()
+    curs.close.assert_called_once_with()
+    conn.close.assert_called_once_with()
+
+
+def test_copy_tables():
+    log = etl.Relation("tgt", "public", "log_mock")
+    good = etl.Table(etl.Relation("src", "public", "good"), etl.Relation("tgt", "public", "good"), "id", "ts")
+    bad = etl.Table(etl.Relation("src", "public", "bad"), etl.Relation("tgt", "public", "bad"), "id", "ts")
+    error = psycopg2.OperationalError("bad table")
+
+    def copy(src, *args, **kwargs):
+        if src.name == "bad":
+            raise error
+        return "mock_max"
+
+    with patch.object(etl, "get_last_uploaded_time", return_value=None) as get_last_uploaded_time, \
+         patch.object(etl, "copy", side_effect=copy) as copy_mock, \
+         patch.object(etl, "log_upload") as log_upload:
+        results = etl.copy_tables([bad, good], log, {"strategy": "values"}, workers=2)
+
+    assert [result.table for result in results] == [bad, good]
+    assert results[0].error is error
+    assert results[0].loaded is None
+    assert results[1].error is None
+    assert results[1].loaded == "mock_max"
+    get_last_uploaded_time.assert_has_calls([call(bad.target, log), call(good.target, log)], any_order=True)
+    copy_mock.assert_any_call(good.source, good.target, "id", "ts", None, log=log, previous=None, stats=ANY,
+                              strategy="values")
+    log_upload.assert_not_called()
+
+
+def test_copy_without_watermark():
+    cursor = get_mock_cursor()
+    type(cursor).description=PropertyMock(return_value=[("foo_column",), ("mock_tstz_field",)])
+    cursor.executemany=MagicMock()
+
+    mock_connection(cursor)
+
+    etl.copy(
+        etl.Relation("src", "src_sch", "src_rel"),
+        etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+        "mock_id",
+        "mock_tstz_field",
+        None
+    )
+
+    assert canonicalize(
+            '''SELECT * FROM "src_sch"."src_rel" WHERE TRUE;'''
+        ) == canonicalize(
+            cursor.execute.call_args.args[0]
+        )
+    assert cursor.execute.call_args.args[1] == ()
+
+
+@pytest.mark.parametrize("plan, uses_index",
+                         [
+                             ({"Node Type": "Index Scan", "Relation Name": "src_rel"}, True),
+                             ({"Node Type": "Gather", "Plans": [{"Node Type": "Seq Scan", "Relation Name": "src_rel"}]}, False),
+                         ])
+def test_check_extraction_plan(plan, uses_index):
+    cursor = get_mock_cursor()
+    cursor.fetchone=MagicMock(return_value=[[{"Plan": plan}]])
+
+    mock_connection(cursor)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        result = etl.check_extraction_plan(etl.Relation("src", "src_sch", "src_rel"), "mock_tstz_field", "mock_datetime")
+
+    assert result == uses_index
+    assert len(caught) == (0 if uses_index else 1)
+    etl.connect.assert_called_once_with("src")
+    assert canonicalize(
+            '''EXPLAIN (FORMAT JSON) SELECT * FROM "src_sch"."src_rel" WHERE "mock_tstz_field" >= %s'''
+        ) == canonicalize(
+            cursor.execute.call_args.args[0]
+        )
+    assert cursor.execute.call_args.args[1] == ("mock_datetime", )
+
+
+def test_check_extraction_plan_without_watermark():
+    mock_connection(get_mock_cursor())
+
+    assert etl.check_extraction_plan(etl.Relation("src", "src_sch", "src_rel"), "mock_tstz_field", None)
+    etl.connect.assert_not_called()
+
+
+@pytest.mark.parametrize("last_upload, copied, since, loaded",
+                         [
+                             (None, None, None, None),
+                             (None, 20, None, 20),
+                             (10, 20, 7, 20),
+                             (10, 9, 7, 10),
+                             (10, None, 7, 10),
+                         ])
+def test_copy_table_watermark(last_upload, copied, since, loaded):
+    log = etl.Relation("tgt", "public", "log_mock")
+    table = etl.Table(etl.Relation("src", "public", "rel"), etl.Relation("tgt", "public", "rel"), "id", "ts")
+
+    with patch.object(etl, "get_last_uploaded_time", return_value=last_upload), \
+         patch.object(etl, "copy", return_value=copied) as copy_mock, \
+         patch.object(etl, "log_upload") as log_upload:
+        result = etl.copy_table(table, log, {}, lookback=3)
+
+    copy_mock.assert_called_once_with(table.source, table.target, "id", "ts", since, log=log, previous=last_upload,
+                                      stats=ANY)
+    log_upload.assert_not_called()
+    assert result == loaded
+
+
+def test_copy_keyset():
+    cursor = get_mock_cursor()
+    type(cursor).description=PropertyMock(return_value=[("id",), ("ts",)])
+    cursor.executemany=MagicMock()
+    pages = [[(1, 10), (2, 10)], [(3, 11)]]
+    cursor.fetchall=MagicMock(side_effect=pages)
+    src = etl.Relation("src", "src_sch", "src_rel")
+    tgt = etl.Relation("tgt", "tgt_sch", "tgt_rel")
+    log = etl.Relation("tgt", "public", "log_mock")
+
+    mock_connection(cursor)
+
+    with patch.object(etl, "log_upload") as log_upload:
+        result = etl.copy_keyset(src, tgt, "id", "ts", log, 9, "7", batch_size=2)
+
+    assert result == 11
+    first_page, second_page = cursor.execute.call_args_list
+    assert canonicalize(
+            '''SELECT * FROM "src_sch"."src_rel" WHERE ("ts", "id") > (%s, %s) ORDER BY "ts", "id" LIMIT %s;'''
+        ) == canonicalize(
+            first_page.args[0]
+        )
+    assert first_page.args[1] == (9, "7", 2)
+    assert second_page.args[1] == (10, "2", 2)
+    assert [c.args[1] for c in cursor.executemany.call_args_list] == pages
+    log_upload.assert_has_calls([call(tgt, log, 10, "2", curs=cursor), call(tgt, log, 11, "3", curs=cursor)])
+    etl.connect.assert_has_calls([call("src"), call("tgt")] * 2, any_order=True)
+
+
+@pytest.mark.parametrize("strategy", ["copy", "pushdown", "carrier_pigeon"])
+def test_copy_keyset_rejects_strategy(strategy):
+    cursor = get_mock_cursor()
+    mock_connection(cursor)
+
+    with pytest.raises(ValueError):
+        etl.copy_keyset(etl.Relation("src", "src_sch", "src_rel"), etl.Relation("tgt", "tgt_sch", "tgt_rel"), "id",
+                        "ts", etl.Relation("tgt", "public", "log_mock"), None, strategy=strategy)
+    etl.connect.assert_not_called()
+
+
+@pytest.mark.parametrize("last_upload, last_key, condition, params",
+                         [
+                             (None, None, '"ts" IS NOT NULL', ()),
+                             (9, None, '"ts" >= %s', (9, )),
+                             (9, "7", '("ts", "id") > (%s, %s)', (9, "7")),
+                         ])
+def test_keyset_filter(last_upload, last_key, condition, params):
+    assert etl.keyset_filter("ts", "id", last_upload, last_key) == (condition, params)
+
+
+def test_copy_table_keyset_resumes_from_checkpoint():
+    log = etl.Relation("tgt", "public", "log_mock")
+    table = etl.Table(etl.Relation("src", "public", "rel"), etl.Relation("tgt", "public", "rel"), "id", "ts")
+
+    with patch.object(etl, "get_checkpoint", return_value=(10, "2")), \
+         patch.object(etl, "copy_keyset", return_value=None) as copy_keyset:
+        result = etl.copy_table(table, log, {"batch_size": 5}, extraction="keyset")
+
+    copy_keyset.assert_called_once_with(table.source, table.target, "id", "ts", log, 10, "2", stats=ANY,
+                                         batch_size=5)
+    assert result == 10
+
+
+def test_copy_table_keyset_lookback_keeps_watermark():
+    log = etl.Relation("tgt", "public", "log_mock")
+    table = etl.Table(etl.Relation("src", "public", "rel"), etl.Relation("tgt", "public", "rel"), "id", "ts")
+    previous = datetime(2020, 1, 2, tzinfo=timezone.utc)
+
+    with patch.object(etl, "copy_keyset", return_value=None) as copy_keyset:
+        result = etl.copy_table(table, log, {}, extraction="keyset", lookback=timedelta(hours=1),
+                                checkpoints={("public", "rel"): (previous, "2")})
+
+    copy_keyset.assert_called_once_with(table.source, table.target, "id", "ts", log, previous - timedelta(hours=1),
+                                         None, stats=ANY, previous=previous)
+    assert result == previous
+
+
+def test_copy_keyset_lookback_checkpoints_past_previous():
+    cursor = get_mock_cursor()
+    type(cursor).description=PropertyMock(return_value=[("id",), ("ts",)])
+    cursor.executemany=MagicMock()
+    cursor.fetchall=MagicMock(side_effect=[[(1, 9), (2, 10)], [(3, 11)]])
+    mock_connection(cursor)
+    tgt = etl.Relation("tgt", "tgt_sch", "tgt_rel")
+    log = etl.Relation("tgt", "public", "log_mock")
+
+    with patch.object(etl, "log_upload") as log_upload:
+        result = etl.copy_keyset(etl.Relation("src", "src_sch", "src_rel"), tgt, "id", "ts", log, 8, None,
+                                 batch_size=2, previous=10)
+
+    assert result == 11
+    log_upload.assert_called_once_with(tgt, log, 11, "3", curs=cursor)
+
+
+def test_get_checkpoints():
+    cursor = get_mock_cursor()
+    cursor.fetchall=MagicMock(return_value=[("tgt_sch", "a", "mock_datetime", "7")])
+
+    mock_connection(cursor)
+
+    result = etl.get_checkpoints(
+        [etl.Relation("tgt", "tgt_sch", "a"), etl.Relation("tgt", "tgt_sch", "b")],
+        etl.Relation("test", "public", "log_mock")
+    )
+
+    assert result == {("tgt_sch", "a"): ("mock_datetime", "7")}
+    etl.connect.assert_called_once_with("test")
+    cursor.execute.assert_called_once()
+    assert canonicalize(
+            '''SELECT schema_name, relation_name, loaded, last_key FROM "public"."log_mock"
+            WHERE (schema_name, relation_name) IN ( SELECT * FROM unnest(%s::TEXT[], %s::TEXT[]) );'''
+        ) == canonicalize(
+            cursor.execute.call_args.args[0]
+        )
+    assert cursor.execute.call_args.args[1] == (["tgt_sch", "tgt_sch"], ["a", "b"])
+
+
+@pytest.mark.parametrize("extraction, checkpoints, expected",
+                         [
+                             ("select", {("public", "rel"): (10, "2")}, (10, None)),
+                             ("select", {}, (None, None)),
+                             ("keyset", {("public", "rel"): (10, "2")}, (10, "2")),
+                         ])
+def test_copy_table_uses_checkpoints(extraction, checkpoints, expected):
+    log = etl.Relation("tgt", "public", "log_mock")
+    table = etl.Table(etl.Relation("src", "public", "rel"), etl.Relation("tgt", "public", "rel"), "id", "ts")
 
-    delete_call, insert_call = cursor.execute.call_args_list
+    with patch.object(etl, "get_last_uploaded_time") as get_last_uploaded_time, \
+         patch.object(etl, "get_checkpoint") as get_checkpoint, \
+         patch.object(etl, "copy", return_value=None) as copy_mock, \
+         patch.object(etl, "copy_keyset", return_value=None) as copy_keyset:
+        etl.copy_table(table, log, {}, lookback=0, extraction=extraction, checkpoints=checkpoints)
 
-    assert len(delete_call.args) == 2
-    assert len(insert_call.args) == 2
+    get_last_uploaded_time.assert_not_called()
+    get_checkpoint.assert_not_called()
+    if extraction == "keyset":
+        copy_keyset.assert_called_once_with(table.source, table.target, "id", "ts", log, *expected, stats=ANY)
+    else:
+        copy_mock.assert_called_once_with(table.source, table.target, "id", "ts", expected[0],
+                                          log=log, previous=expected[0], stats=ANY)
+
+
+@pytest.mark.parametrize("existing, added", [(["a", "b"], []), (["a"], ["b"])])
+def test_make_sure_columns_exist(existing, added):
+    cursor = get_mock_cursor()
+    cursor.fetchall=MagicMock(return_value=[(name, "text") for name in existing])
+    mock_connection(cursor)
+
+    etl.make_sure_columns_exist(etl.Relation("test", "public", "log_mock"),
+                                [etl.Column("a", "TEXT"), etl.Column("b", "TEXT")])
+
+    lookup, *alters = cursor.execute.call_args_list
+    assert "information_schema.columns" in lookup.args[0]
+    assert [canonicalize(c.args[0]) for c in alters] == \
+        [f'alter table "public"."log_mock" add column if not exists "{name}" text;' for name in added]
+
+
+def test_make_sure_primary_key_exists_keeps_newest():
+    cursor = get_mock_cursor()
+    cursor.fetchone=MagicMock(return_value=None)
+    mock_connection(cursor)
+
+    etl.make_sure_primary_key_exists(etl.Relation("test", "public", "log_mock"), etl.LOG_KEY, "loaded")
 
+    _, dedup, _ = cursor.execute.call_args_list
     assert canonicalize(
-            '''DELETE FROM "public"."log_mock" WHERE schema_name=%s AND relation_name=%s;'''
+            '''DELETE FROM "public"."log_mock" AS a USING "public"."log_mock" AS b
+            WHERE a."schema_name" = b."schema_name" AND a."relation_name" = b."relation_name"
+            AND (a."loaded" < b."loaded" OR (a."loaded" IS NULL AND b."loaded" IS NOT NULL)
+            OR (a."loaded" IS NOT DISTINCT FROM b."loaded" AND a.ctid < b.ctid));'''
         ) == canonicalize(
-            delete_call.args[0]
+            dedup.args[0]
         )
-    assert delete_call.args[1] == ('bar', 'baz')
-    
+
+
+@pytest.mark.parametrize("has_key", [True, False])
+def test_make_sure_primary_key_exists(has_key):
+    cursor = get_mock_cursor()
+    cursor.fetchone=MagicMock(return_value=(1, ) if has_key else None)
+
+    mock_connection(cursor)
+
+    etl.make_sure_primary_key_exists(etl.Relation("test", "public", "log_mock"), etl.LOG_KEY)
+
+    if has_key:
+        cursor.execute.assert_called_once()
+        return
+    _, dedup, alter = cursor.execute.call_args_list
     assert canonicalize(
-            '''INSERT INTO "public"."log_mock" (schema_name, relation_name, loaded) VALUES (%s, %s, %s);'''
+            '''DELETE FROM "public"."log_mock" AS a USING "public"."log_mock" AS b
+            WHERE a."schema_name" = b."schema_name" AND a."relation_name" = b."relation_name" AND a.ctid < b.ctid;'''
         ) == canonicalize(
-            insert_call.args[0]
+            dedup.args[0]
         )
-    assert insert_call.args[1] == ('bar', 'baz', 'mock_datetime')
+    assert alter.args[0] == 'ALTER TABLE "public"."log_mock" ADD PRIMARY KEY ("schema_name", "relation_name");'
+
+
+def test_copy_pipelined():
+    cursor = get_mock_cursor()
+    loaded = []
+    cursor.executemany=MagicMock(side_effect=lambda query, rows: loaded.append(rows))
+    named_cursor = get_mock_cursor()
+    type(named_cursor).description=PropertyMock(return_value=[("foo_column",), ("mock_tstz_field",)])
+    batches = [[("a", 1), ("b", 4)], [("c", 2), ("d", 3)], [("e", 3)], []]
+    named_cursor.fetchmany=MagicMock(side_effect=batches)
+
+    ctx = mock_connection(cursor)
+    ctx.__enter__.return_value[0].cursor=MagicMock(return_value=named_cursor)
+
+    result = etl.copy(
+        etl.Relation("src", "src_sch", "src_rel"),
+        etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+        "mock_id",
+        "mock_tstz_field",
+        "mock_datetime",
+        batch_size=2,
+        loaders=2,
+        queue_depth=1
+    )
+
+    assert result == 4
+    assert sorted(loaded) == sorted(batches[:3])
+    assert etl.connect.call_args_list.count(call("tgt")) == 2
+    named_cursor.close.assert_called_once_with()
+
+
+def test_copy_pipelined_load_error():
+    cursor = get_mock_cursor()
+    cursor.executemany=MagicMock(side_effect=psycopg2.IntegrityError("mock"))
+    named_cursor = get_mock_cursor()
+    type(named_cursor).description=PropertyMock(return_value=[("foo_column",), ("mock_tstz_field",)])
+    named_cursor.fetchmany=MagicMock(return_value=[("a", 1), ("b", 2)])
+
+    ctx = mock_connection(cursor)
+    ctx.__exit__.return_value = False
+    ctx.__enter__.return_value[0].cursor=MagicMock(return_value=named_cursor)
+
+    with pytest.raises(psycopg2.IntegrityError):
+        etl.copy_pipelined(
+            etl.Relation("src", "src_sch", "src_rel"),
+            etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+            "mock_id",
+            "mock_tstz_field",
+            "mock_datetime",
+            batch_size=2,
+            loaders=1,
+            queue_depth=1
+        )
+
+
+def test_copy_pipelined_one_of_several_loaders_fails():
+    cursor = get_mock_cursor()
+    cursor.executemany=MagicMock(side_effect=[psycopg2.IntegrityError("mock")] + [None] * 1000)
+    named_cursor = get_mock_cursor()
+    type(named_cursor).description=PropertyMock(return_value=[("foo_column",), ("mock_tstz_field",)])
+    named_cursor.fetchmany=MagicMock(return_value=[("a", 1), ("b", 2)])
+
+    ctx = mock_connection(cursor)
+    ctx.__exit__.return_value = False
+    ctx.__enter__.return_value[0].cursor=MagicMock(return_value=named_cursor)
+    errors = []
+
+    def run():
+        try:
+            etl.copy_pipelined(etl.Relation("src", "src_sch", "src_rel"), etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+                               "mock_id", "mock_tstz_field", "mock_datetime", batch_size=2, loaders=2,
+                               queue_depth=1)
+        except Exception as e:
+            errors.append(e)
+
+    copying = threading.Thread(target=run, daemon=True)
+    copying.start()
+    copying.join(5)
+    assert not copying.is_alive()
+    assert [type(e) for e in errors] == [psycopg2.IntegrityError]
+    # Neither loader commits, both leave their connect() block with an exception to roll back
+    ctx.__enter__.return_value[0].commit.assert_not_called()
+    exits = [c.args[0] for c in ctx.__exit__.call_args_list if c.args[0] is not None]
+    assert psycopg2.IntegrityError in exits and len(exits) >= 2
+
+
+@pytest.mark.parametrize("stats, min_max, points",
+                         [
+                             ([[str(i) for i in range(0, 100, 10)]], None, ["30", "60"]),
+                             ([None], (1, 100), [34, 67]),
+                             (None, (1, 3), [1, 2]),
+                             (None, ("a", "z"), []),
+                             (None, (None, None), []),
+                         ])
+def test_key_split_points(stats, min_max, points):
+    cursor = get_mock_cursor()
+    cursor.fetchone=MagicMock(side_effect=[stats, min_max])
+
+    mock_connection(cursor)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        result = etl.key_split_points(etl.Relation("src", "src_sch", "src_rel"), "id", 3)
+
+    assert result == points
+    assert cursor.execute.call_args_list[0].args[1] == ("src_sch", "src_rel", "id")
+
+
+def test_key_range_filters():
+    assert etl.key_range_filters("id", []) == [("TRUE", ())]
+    assert etl.key_range_filters("id", [10, 20]) == [
+        ('"id" < %s OR "id" IS NULL', (10, )),
+        ('"id" >= %s AND "id" < %s', (10, 20)),
+        ('"id" >= %s', (20, )),
+    ]
+
+
+def test_copy_with_extra_condition():
+    cursor = get_mock_cursor()
+    type(cursor).description=PropertyMock(return_value=[("foo_column",), ("mock_tstz_field",)])
+    cursor.executemany=MagicMock()
+
+    mock_connection(cursor)
+
+    etl.copy(
+        etl.Relation("src", "src_sch", "src_rel"),
+        etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+        "mock_id",
+        "mock_tstz_field",
+        "mock_datetime",
+        where=('"mock_id" >= %s', (10, ))
+    )
+
+    assert canonicalize(
+            '''SELECT * FROM "src_sch"."src_rel" WHERE "mock_tstz_field" >= %s AND ("mock_id" >= %s);'''
+        ) == canonicalize(
+            cursor.execute.call_args.args[0]
+        )
+    assert cursor.execute.call_args.args[1] == ("mock_datetime", 10)
+
+
+def mock_exported_snapshot(snapshot="mock_snapshot"):
+    exported = MagicMock()
+    exported.return_value.__enter__.return_value = snapshot
+    return patch.object(etl, "exported_snapshot", exported)
+
+
+def test_copy_partitioned():
+    src = etl.Relation("src", "src_sch", "src_rel")
+    tgt = etl.Relation("tgt", "tgt_sch", "tgt_rel")
+    filters = [("a", ()), ("b", ()), ("c", ())]
+    watermarks = {"a": 3, "b": None, "c": 5}
+
+    def copy(*args, where, **kwargs):
+        return watermarks[where[0]]
+
+    with patch.object(etl, "ProcessPoolExecutor", lambda max_workers, mp_context: ThreadPoolExecutor(max_workers)), \
+         patch.object(etl, "copy", side_effect=copy) as copy_mock, mock_exported_snapshot() as exported:
+        result = etl.copy_partitioned(src, tgt, "id", "ts", None, filters, {"strategy": "merge"})
+
+    assert result == 5
+    exported.assert_called_once_with("src")
+    for where in filters:
+        copy_mock.assert_any_call(src, tgt, "id", "ts", None, where=where, strategy="merge",
+                                  snapshot="mock_snapshot", stats=ANY)
+
+
+def test_copy_partitioned_given_snapshot():
+    with patch.object(etl, "ProcessPoolExecutor", lambda max_workers, mp_context: ThreadPoolExecutor(max_workers)), \
+         patch.object(etl, "copy", return_value=1) as copy_mock, mock_exported_snapshot() as exported:
+        etl.copy_partitioned(etl.Relation("src", "s", "r"), etl.Relation("tgt", "s", "r"), "id", "ts", None,
+                             [("a", ()), ("b", ())], {"snapshot": "run_snapshot"})
+
+    exported.assert_not_called()
+    assert {c.kwargs["snapshot"] for c in copy_mock.call_args_list} == {"run_snapshot"}
+
+
+def test_copy_partitioned_error():
+    done = []
+
+    def copy(*args, where, **kwargs):
+        if where[0] == "a":
+            raise psycopg2.OperationalError("mock")
+        done.append(where)
+        return 1
+
+    with patch.object(etl, "ProcessPoolExecutor", lambda max_workers, mp_context: ThreadPoolExecutor(max_workers)), \
+         patch.object(etl, "copy", side_effect=copy), mock_exported_snapshot():
+        with pytest.raises(psycopg2.OperationalError):
+            etl.copy_partitioned(etl.Relation("src", "s", "r"), etl.Relation("tgt", "s", "r"), "id", "ts", None,
+                                 [("a", ()), ("b", ())], {})
+    assert done == [("b", ())]
+
+
+def test_copy_partitioned_unlogged_staging():
+    with patch.object(etl, "ProcessPoolExecutor") as executor, pytest.raises(ValueError):
+        etl.copy_partitioned(etl.Relation("src", "src_sch", "src_rel"), etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+                             "id", "ts", None, [("TRUE", ()), ("TRUE", ())],
+                             {"strategy": "merge", "staging": "unlogged"})
+    executor.assert_not_called()
+
+
+@pytest.mark.parametrize("server_version, blocks, filters",
+                         [
+                             (130000, 100, None),
+                             (140000, 0, [("TRUE", ())]),
+                             (160002, 100, [
+                                 ("ctid < %s::TID", ("(33,0)", )),
+                                 ("ctid >= %s::TID AND ctid < %s::TID", ("(33,0)", "(66,0)")),
+                                 ("ctid >= %s::TID", ("(66,0)", )),
+                             ]),
+                         ])
+def test_block_range_filters(server_version, blocks, filters):
+    cursor = get_mock_cursor()
+    cursor.fetchone=MagicMock(return_value=[blocks])
+
+    ctx = mock_connection(cursor)
+    ctx.__enter__.return_value[0].server_version = server_version
+
+    result = etl.block_range_filters(etl.Relation("src", "src_sch", "src_rel"), 3)
+
+    assert result == filters
+    if filters is not None:
+        assert cursor.execute.call_args.args[1] == ("src_sch", "src_rel")
+
+
+@pytest.mark.parametrize("last_upload, block_filters, key_split",
+                         [
+                             (None, [("ctid", ())], False),
+                             (None, None, True),
+                             (datetime(2020, 1, 1, tzinfo=timezone.utc), None, True),
+                         ])
+def test_copy_table_partitioned(last_upload, block_filters, key_split):
+    log = etl.Relation("tgt", "public", "log_mock")
+    table = etl.Table(etl.Relation("src", "public", "rel"), etl.Relation("tgt", "public", "rel"), "id", "ts")
+
+    with patch.object(etl, "get_last_uploaded_time", return_value=last_upload), \
+         patch.object(etl, "block_range_filters", return_value=block_filters) as block_range_filters, \
+         patch.object(etl, "key_split_points", return_value=[5]), \
+         patch.object(etl, "copy_partitioned", return_value=datetime(2021, 1, 1, tzinfo=timezone.utc)) as copy_partitioned, \
+         patch.object(etl, "log_upload") as log_upload:
+        etl.copy_table(table, log, {}, partitions=2)
+
+    assert block_range_filters.called == (last_upload is None)
+    filters = copy_partitioned.call_args.args[5]
+    if key_split:
+        assert filters == etl.key_range_filters("id", [5])
+    else:
+        assert filters == block_filters
+    log_upload.assert_called_once_with(table.target, log, datetime(2021, 1, 1, tzinfo=timezone.utc))
+
+
+def test_exported_snapshot():
+    cursor = get_mock_cursor()
+    cursor.fetchone=MagicMock(return_value=["00000003-0000001B-1"])
+
+    ctx = mock_connection(cursor)
+
+    with etl.exported_snapshot("src") as snapshot:
+        ctx.__exit__.assert_not_called()
+
+    assert snapshot == "00000003-0000001B-1"
+    etl.connect.assert_called_once_with("src")
+    ctx.__exit__.assert_called_once()
+    assert [c.args[0] for c in cursor.execute.call_args_list] == [
+        "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;",
+        "SELECT pg_export_snapshot();",
+    ]
+
+
+def test_copy_with_snapshot():
+    cursor = get_mock_cursor()
+    type(cursor).description=PropertyMock(return_value=[("foo_column",), ("mock_tstz_field",)])
+    cursor.executemany=MagicMock()
+
+    mock_connection(cursor)
+
+    etl.copy(
+        etl.Relation("src", "src_sch", "src_rel"),
+        etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+        "mock_id",
+        "mock_tstz_field",
+        "mock_datetime",
+        snapshot="mock_snapshot"
+    )
+
+    isolation_call, snapshot_call, select_call = cursor.execute.call_args_list
+    assert isolation_call.args == ("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;", )
+    assert snapshot_call.args == ("SET TRANSACTION SNAPSHOT %s;", ("mock_snapshot", ))
+    assert select_call.args[0].lstrip().startswith("SELECT *")
+
+
+def test_copy_table_snapshot():
+    log = etl.Relation("tgt", "public", "log_mock")
+    table = etl.Table(etl.Relation("src", "public", "rel"), etl.Relation("tgt", "public", "rel"), "id", "ts")
+    copy_options = {"strategy": "merge"}
+
+    with patch.object(etl, "get_last_uploaded_time", return_value=None), \
+         patch.object(etl, "copy", return_value=None) as copy_mock, \
+         patch.object(etl, "log_upload"):
+        etl.copy_table(table, log, copy_options, snapshots={"src": "mock_snapshot", "other": "other_snapshot"})
+
+    copy_mock.assert_called_once_with(table.source, table.target, "id", "ts", None, log=log, previous=None,
+                                      stats=ANY, strategy="merge", snapshot="mock_snapshot")
+    assert copy_options == {"strategy": "merge"}
+
+
+def test_make_sure_foreign_table_exists():
+    cursor = get_mock_cursor()
+    cursor.fetchone=MagicMock(return_value=[None])
+
+    mock_connection(cursor)
+
+    with patch.object(etl, "get_connect_arguments", return_value={"host": "localhost", "port": 5432, "user": "etl"}):
+        result = etl.make_sure_foreign_table_exists(etl.Relation("src", "src_sch", "src_rel"), "tgt")
+
+    assert result == '"etl_src_src_sch"."src_rel"'
+    etl.connect.assert_called_once_with("tgt")
+    statements = [canonicalize(c.args[0]) for c in cursor.execute.call_args_list]
+    assert statements[1] == canonicalize("CREATE EXTENSION IF NOT EXISTS postgres_fdw;")
+    assert statements[2] == canonicalize(
+        '''CREATE SERVER IF NOT EXISTS "etl_src" FOREIGN DATA WRAPPER postgres_fdw OPTIONS (dbname %s, host %s, port %s);'''
+    )
+    assert cursor.execute.call_args_list[2].args[1] == ("src", "localhost", "5432")
+    assert statements[3] == canonicalize(
+        '''CREATE USER MAPPING IF NOT EXISTS FOR CURRENT_USER SERVER "etl_src" OPTIONS (user %s);'''
+    )
+    assert cursor.execute.call_args_list[3].args[1] == ("etl", )
+    assert statements[-1] == canonicalize(
+        '''IMPORT FOREIGN SCHEMA "src_sch" LIMIT TO ("src_rel") FROM SERVER "etl_src" INTO "etl_src_src_sch";'''
+    )
+
+
+def test_copy_pushdown():
+    cursor = get_mock_cursor()
+    cursor.fetchall=MagicMock(return_value=[("id", "integer"), ("ts", "timestamp with time zone")])
+    cursor.fetchone=MagicMock(return_value=[3, 2, "mock_max"])
+
+    mock_connection(cursor)
+    stats = etl.CopyStats()
+
+    with patch.object(etl, "make_sure_foreign_table_exists", return_value='"etl_src_s"."src_rel"'):
+        result = etl.copy(
+            etl.Relation("src", "src_sch", "src_rel"),
+            etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+            "id",
+            "ts",
+            "mock_datetime",
+            strategy="pushdown",
+            stats=stats
+        )
+
+    assert result == "mock_max"
+    assert (stats.rows_extracted, stats.rows_inserted, stats.bytes_sent) == (3, 2, None)
+    assert canonicalize(
+            '''WITH extracted AS MATERIALIZED ( SELECT "id", "ts" FROM "etl_src_s"."src_rel" WHERE "ts" >= %s ),
+            inserted AS ( INSERT INTO "tgt_sch"."tgt_rel" ("id", "ts") SELECT "id", "ts" FROM extracted
+            ON CONFLICT ("id") DO NOTHING RETURNING 1 )
+            SELECT count(*), (SELECT count(*) FROM inserted), max("ts") FROM extracted;'''
+        ) == canonicalize(
+            cursor.execute.call_args.args[0]
+        )
+    assert cursor.execute.call_args.args[1] == ("mock_datetime", )
+
+
+@pytest.mark.parametrize("log_db, loaders, in_transaction",
+                         [
+                             ("tgt", 0, True),
+                             ("other", 0, False),
+                             ("tgt", 2, False),
+                         ])
+def test_copy_logs_watermark(log_db, loaders, in_transaction):
+    cursor = get_mock_cursor()
+    named_cursor = get_mock_cursor()
+    type(named_cursor).description=PropertyMock(return_value=[("foo_column",), ("mock_tstz_field",)])
+    named_cursor.fetchmany=MagicMock(side_effect=[[("a", 1), ("b", 3)], []])
+    log = etl.Relation(log_db, "public", "log_mock")
+    tgt = etl.Relation("tgt", "tgt_sch", "tgt_rel")
+
+    ctx = mock_connection(cursor)
+    ctx.__enter__.return_value[0].cursor=MagicMock(return_value=named_cursor)
+
+    with patch.object(etl, "log_upload") as log_upload:
+        result = etl.copy(
+            etl.Relation("src", "src_sch", "src_rel"),
+            tgt,
+            "mock_id",
+            "mock_tstz_field",
+            "mock_datetime",
+            batch_size=2,
+            loaders=loaders,
+            log=log,
+            previous=2
+        )
+
+    assert result == 3
+    if in_transaction:
+        log_upload.assert_called_once_with(tgt, log, 3, curs=cursor)
+    else:
+        log_upload.assert_called_once_with(tgt, log, 3)
+
+
+def test_copy_nothing_new_keeps_watermark():
+    cursor = get_mock_cursor()
+    named_cursor = get_mock_cursor()
+    named_cursor.fetchmany=MagicMock(return_value=[])
+
+    ctx = mock_connection(cursor)
+    ctx.__enter__.return_value[0].cursor=MagicMock(return_value=named_cursor)
+
+    with patch.object(etl, "log_upload") as log_upload:
+        result = etl.copy(
+            etl.Relation("src", "src_sch", "src_rel"),
+            etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+            "mock_id",
+            "mock_tstz_field",
+            "mock_datetime",
+            batch_size=2,
+            log=etl.Relation("tgt", "public", "log_mock"),
+            previous=2
+        )
+
+    assert result is None
+    log_upload.assert_not_called()
+
+
+def test_copy_stats_add():
+    stats, part = etl.CopyStats(), etl.CopyStats()
+    stats.rows_extracted, stats.rows_inserted, stats.load_seconds = 5, 3, 1.5
+    part.rows_extracted, part.rows_inserted, part.load_seconds = 2, 2, 0.5
+    part.add_bytes(10)
+
+    stats.add(part)
+
+    assert (stats.rows_extracted, stats.rows_inserted, stats.rows_skipped) == (7, 5, 2)
+    assert stats.bytes_sent == 10
+    assert stats.load_seconds == 2.0
+
+
+def test_copy_stats_timing():
+    stats = etl.CopyStats()
+
+    with pytest.raises(ValueError):
+        with stats.timing("extract"):
+            raise ValueError("mock")
+
+    assert stats.extract_seconds > 0
+    assert stats.load_seconds == 0
+
+
+def test_copy_batches_stats():
+    cursor = get_mock_cursor()
+    type(cursor).description=PropertyMock(return_value=[("foo_column",), ("mock_tstz_field",)])
+    cursor.executemany=MagicMock()
+    cursor.fetchall=MagicMock(return_value=[("a", 1), ("b", 2), ("c", 3)])
+    cursor.rowcount=2
+    ctx = mock_connection(cursor)
+    stats = etl.CopyStats()
+
+    etl.copy(etl.Relation("src", "src_sch", "src_rel"), etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+             "mock_id", "mock_tstz_field", None, stats=stats)
+
+    assert (stats.rows_extracted, stats.rows_inserted, stats.rows_skipped) == (3, 2, 1)
+    assert stats.bytes_sent is None
+    # The query, a round trip per row inserted by executemany() and the commit
+    assert (stats.batches, stats.round_trips) == (1, 5)
+    assert stats.extract_seconds > 0 and stats.load_seconds > 0 and stats.commit_seconds > 0
+    ctx.__enter__.return_value[0].commit.assert_called_once_with()
+
+
+def test_record_run():
+    cursor = get_mock_cursor()
+    mock_connection(cursor)
+    stats = etl.CopyStats()
+    stats.rows_extracted, stats.rows_inserted = 3, 2
+
+    etl.record_run(etl.Relation("test", "public", "history_mock"), "mock_run", etl.Relation("tgt", "tgt_sch", "rel"),
+                   "mock_started", "mock_before", "mock_after", stats, ValueError("mock"))
+
+    etl.connect.assert_called_once_with("test")
+    query, params = cursor.execute.call_args.args
+    assert canonicalize(query).startswith('insert into "public"."history_mock" (run_id, schema_name, relation_name,')
+    assert params[:4] == ("mock_run", "tgt_sch", "rel", "mock_started")
+    assert params[5:] == ("mock_before", "mock_after", 3, 2, 1, None, 0.0, 0.0, 0.0, "ValueError('mock')")
+
+
+@pytest.mark.parametrize("error", [None, psycopg2.OperationalError("mock")])
+def test_copy_table_records_history(error):
+    log = etl.Relation("tgt", "public", "log_mock")
+    history = etl.Relation("tgt", "public", "history_mock")
+    table = etl.Table(etl.Relation("src", "public", "rel"), etl.Relation("tgt", "public", "rel"), "id", "ts")
+
+    def copy(*args, stats, **kwargs):
+        stats.rows_extracted += 4
+        if error:
+            raise error
+        return 20
+
+    with patch.object(etl, "copy", side_effect=copy), \
+         patch.object(etl, "record_run") as record_run:
+        if error:
+            with pytest.raises(psycopg2.OperationalError):
+                etl.copy_table(table, log, {}, checkpoints={("public", "rel"): (10, None)}, lookback=0,
+                               history=history, run_id="mock_run")
+        else:
+            etl.copy_table(table, log, {}, checkpoints={("public", "rel"): (10, None)}, lookback=0,
+                           history=history, run_id="mock_run")
+
+    record_run.assert_called_once_with(history, "mock_run", table.target, ANY, 10, 10 if error else 20, ANY, error)
+    assert record_run.call_args.args[6].rows_extracted == 4
+
+
+def test_make_sure_index_exists():
+    cursor = get_mock_cursor()
+    mock_connection(cursor)
+
+    etl.make_sure_index_exists(etl.Relation("test", "public", "history_mock"), ("relation_name", "started"))
+
+    assert canonicalize(
+            '''CREATE INDEX IF NOT EXISTS "history_mock_relation_name_started_idx"
+            ON "public"."history_mock" ("relation_name", "started");'''
+        ) == canonicalize(
+            cursor.execute.call_args.args[0]
+        )
+
+
+def test_run_metrics():
+    metrics = etl.RunMetrics()
+    metrics.add_operation("connect", 0.5, db="src")
+    metrics.add_operation("connect", 0.25, db="src")
+    stats = etl.CopyStats()
+    stats.rows_extracted, stats.rows_inserted, stats.batches, stats.load_seconds = 10, 8, 2, 1.5
+    metrics.add_copy(etl.Relation("tgt", "public", 'we"ird'), stats, 2.0)
+
+    text = metrics.prometheus(True)
+
+    assert "# TYPE etl_operation_calls gauge" in text
+    assert 'etl_operation_calls{db="src",operation="connect"} 2' in text
+    assert 'etl_operation_seconds{db="src",operation="connect"} 0.75' in text
+    assert 'etl_copy_rows{schema="public",table="we\\"ird",kind="skipped"} 2' in text
+    assert 'etl_copy_stage_seconds{schema="public",table="we\\"ird",stage="load"} 1.5' in text
+    assert "etl_last_run_success 1" in text
+    assert "etl_copy_bytes_sent" not in text
+
+    summary = metrics.summary(False)
+    assert summary["success"] is False
+    assert summary["operations"] == [{"db": "src", "operation": "connect", "calls": 2, "seconds": 0.75}]
+    assert summary["tables"]['public.we"ird']["rows_per_second"] == 5
+    assert summary["tables"]['public.we"ird']["batches"] == 2
+
+
+def test_write_metrics(tmp_path):
+    textfile, summary = tmp_path / "etl.prom", tmp_path / "etl.json"
+
+    with patch.object(etl, "_metrics", etl.RunMetrics()):
+        etl.measured("mock_operation")(lambda: None)()
+        etl.write_metrics(True, str(textfile), str(summary))
+
+    assert 'etl_operation_calls{operation="mock_operation"} 1' in textfile.read_text()
+    assert json.loads(summary.read_text())["operations"][0]["calls"] == 1
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["etl.json", "etl.prom"]
+
+
+def test_copy_table_records_metrics():
+    log = etl.Relation("tgt", "public", "log_mock")
+    table = etl.Table(etl.Relation("src", "public", "rel"), etl.Relation("tgt", "public", "rel"), "id", "ts")
+
+    def copy(*args, stats, **kwargs):
+        stats.rows_extracted += 4
+        return 20
+
+    with patch.object(etl, "_metrics", etl.RunMetrics()) as metrics, \
+         patch.object(etl, "copy", side_effect=copy):
+        etl.copy_table(table, log, {}, checkpoints={}, lookback=0)
+        etl.copy_table(table, log, {}, checkpoints={}, lookback=0)
+
+    stats, seconds = metrics.copies[("public", "rel")]
+    assert stats.rows_extracted == 8
+    assert seconds > 0
+
+
+def test_set_connect_arguments():
+    etl.set_connect_arguments({"host": "/tmp/mock", "user": "postgres"})
+    try:
+        dsn = etl.get_connect_arguments()
+        dsn["dbname"] = "mock"
+        assert etl.get_connect_arguments() == {"host": "/tmp/mock", "user": "postgres"}
+    finally:
+        etl.set_connect_arguments(None)
+    assert etl.get_connect_arguments() == config.db
+
+
+@pytest.mark.parametrize("candidate, regressed, note",
+                         [
+                             ([100, 98, 102], False, ""),
+                             ([80, 81, 82], True, ""),
+                             ([90, 60, 120], False, "within noise"),
+                         ])
+def test_bench_compare_throughput(candidate, regressed, note):
+    def scenarios(values):
+        return {"a/10/insert/full": {"runs": [{"rows_per_second": value, "peak_rss_bytes": 100} for value in values]}}
+
+    throughput, memory = bench_compare.compare(scenarios([100, 95, 105]), scenarios(candidate), 0.05, 0.1)
+
+    assert (throughput.metric, throughput.regressed, throughput.note) == ("rows_per_second", regressed, note)
+    assert not memory.regressed
+
+
+def test_bench_compare_failed_and_missing():
+    baseline = {"a": {"runs": [{"rows_per_second": 1, "peak_rss_bytes": 1}]},
+                "b": {"runs": [{"rows_per_second": 1, "peak_rss_bytes": 1}]},
+                "c": {"runs": [{"error": "mock"}]}}
+    candidate = {"a": {"runs": [{"error": "mock"}]}}
+
+    failed, missing = bench_compare.compare(baseline, candidate, 0.05, 0.1)
+
+    assert (failed.name, failed.regressed, failed.note) == ("a", True, "failed in candidate")
+    assert (missing.name, missing.regressed, missing.note) == ("b", False, "missing in candidate")
+
+
+def test_batch_sizer_starts_within_memory():
+    assert etl.BatchSizer(10000, 100, memory=500000).size == 5000
+    assert etl.BatchSizer(10000, 10, memory=500000).size == 10000
+    assert etl.BatchSizer(10000, 10 ** 9, memory=500000).size == 100
+
+
+def test_batch_sizer_follows_throughput():
+    sizer = etl.BatchSizer(1000, 10, memory=10 ** 9, max_latency=10)
+    rows = [(1, )] * 1000
+
+    sizer.observe(rows, 1.0)
+    assert sizer.size == 1500
+    # Faster, keep growing
+    sizer.observe(rows[:1], 0.0005)
+    assert sizer.size == 2250
+    # Slower, turn around
+    sizer.observe(rows[:1], 0.01)
+    assert sizer.size == 1500
+    # Too slow a round always shrinks
+    sizer.observe(rows, 20)
+    assert sizer.size == 1000
+
+
+def test_batch_sizer_measures_rows():
+    sizer = etl.BatchSizer(1000, 10, memory=10 ** 6)
+    wide = [("x" * 1000, )] * 1000
+
+    sizer.observe(wide, 1.0)
+
+    assert sizer.row_bytes == etl.row_size(wide[0])
+    assert sizer.size == 10 ** 6 // sizer.row_bytes
+
+
+def test_estimate_row_bytes():
+    cursor = get_mock_cursor()
+    cursor.fetchone=MagicMock(side_effect=[(100, 4), (None, 0)])
+    mock_connection(cursor)
+    src = etl.Relation("src", "src_sch", "src_rel")
+
+    assert etl.estimate_row_bytes(src) > 100 + 4 * 8
+    assert cursor.execute.call_args.args[1] == ("src_sch", "src_rel")
+    assert etl.estimate_row_bytes(src) is None
+
+
+def test_copy_adaptive_batches():
+    cursor = get_mock_cursor()
+    cursor.executemany=MagicMock()
+    named_cursor = get_mock_cursor()
+    type(named_cursor).description=PropertyMock(return_value=[("foo_column",), ("mock_tstz_field",)])
+    batches = iter([[("a", 1)] * 200, [("a", 1)] * 300, [("b", 2)], []])
+    named_cursor.fetchmany=MagicMock(side_effect=lambda size: next(batches))
+
+    ctx = mock_connection(cursor)
+    ctx.__enter__.return_value[0].cursor=MagicMock(return_value=named_cursor)
+
+    with patch.object(etl, "estimate_row_bytes", return_value=100):
+        result = etl.copy(etl.Relation("src", "src_sch", "src_rel"), etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+                          "mock_id", "mock_tstz_field", None, batch_size=200, adaptive_batches=True,
+                          batch_memory=10 ** 6)
+
+    assert result == 2
+    # Later sizes depend on how fast the rounds went
+    sizes = [c.args[0] for c in named_cursor.fetchmany.call_args_list]
+    assert sizes[:2] == [200, 300] and len(sizes) == 4
+
+
+@pytest.fixture
+def governor():
+    # Long interval, the tests set the RSS themselves
+    governor = etl.MemoryGovernor(1000, interval=60, max_pause=0.05)
+    yield governor
+    governor.stop()
+
+
+@pytest.mark.parametrize("rss, size", [(500, 10000), (800, 10000), (900, 5000), (1000, 1000), (2000, 1000)])
+def test_memory_governor_batch_size(governor, rss, size):
+    governor.rss = rss
+    assert governor.batch_size(10000) == size
+
+
+def test_memory_governor_pause_gives_up(governor):
+    governor.rss = 990
+    with patch.object(etl, "_metrics", etl.RunMetrics()) as metrics:
+        governor.wait()
+    assert metrics.operations[("memory_pause", ())][0] == 1
+
+    governor.rss = 500
+    with patch.object(etl, "_metrics", etl.RunMetrics()) as metrics:
+        governor.wait()
+    assert not metrics.operations
+
+
+def test_memory_governor_admits_one_table_under_pressure(governor):
+    governor.rss = 900
+    started = []
+
+    def start():
+        with governor.admitted():
+            started.append(True)
+
+    with governor.admitted():
+        thread = threading.Thread(target=start)
+        thread.start()
+        thread.join(0.2)
+        assert not started
+        governor.rss = 100
+    thread.join()
+    assert started
+
+
+def test_governed_batch_size(governor):
+    assert etl.governed_batch_size(10000) == 10000
+    governor.rss = 900
+    with patch.object(etl, "_governor", governor):
+        assert etl.governed_batch_size(10000) == 5000
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_spill_round_trip(tmp_path, compression):
+    directory = str(tmp_path / "spill")
+    writer = spill.SpillWriter(directory, compression, source=["src", "src_sch", "src_rel"])
+    payloads = [b"1\tfoo\n", b"2\tbar\n3\tbaz\n", b""]
+    for rows, payload in enumerate(payloads):
+        writer.write(payload, rows, f"2020-01-0{rows + 1}T00:00:00+00:00")
+    assert spill.read_manifest(directory) is None
+
+    writer.close()
+    manifest = spill.read_manifest(directory)
+    assert manifest["source"] == ["src", "src_sch", "src_rel"]
+    assert [batch["rows"] for batch in manifest["batches"]] == [0, 1, 2]
+    assert list(spill.read_batches(directory, manifest)) == list(enumerate(payloads))
+    assert list(spill.read_batches(directory, manifest, 1)) == list(enumerate(payloads))[1:]
+    assert list(spill.read_batches(directory, manifest, 3)) == []
+    if compression is None:
+        with open(tmp_path / "spill" / manifest["file"], "rb") as file:
+            data = file.read()
+        for batch, payload in zip(manifest["batches"], payloads):
+            start = batch["payload_offset"]
+            assert data[start:start + batch["payload_length"]] == payload
+
+
+@pytest.mark.parametrize("start", [0, 1, 2])
+def test_spill_mapped_batches(tmp_path, start):
+    directory = str(tmp_path / "spill")
+    payloads = [b"1\tfoo\n", b"2\tbar\n" * 1000]
+    write_spill(directory, [(payload, 1, None) for payload in payloads])
+    manifest = spill.read_manifest(directory)
+
+    mapped = [(number, payload.tobytes()) for number, payload in spill.mapped_batches(directory, manifest, start)]
+
+    assert mapped == list(enumerate(payloads))[start:]
+
+
+def test_spill_payload_reader():
+    reader = spill.PayloadReader(memoryview(b"0123456789"))
+    assert [reader.read(4), reader.read(4), reader.read(4), reader.read(4)] == [b"0123", b"4567", b"89", b""]
+    assert spill.PayloadReader(b"0123").read() == b"0123"
+
+
+def test_spill_abort_and_progress(tmp_path):
+    directory = str(tmp_path / "spill")
+    writer = spill.SpillWriter(directory)
+    writer.write(b"1\n", 1, None)
+    writer.abort()
+    assert not (tmp_path / "spill").exists()
+
+    assert spill.loaded_batches(directory) == 0
+    spill.SpillWriter(directory).close()
+    spill.mark_loaded(directory, 2)
+    assert spill.loaded_batches(directory) == 2
+
+
+def test_spill_unknown_compression(tmp_path):
+    with pytest.raises(ValueError):
+        spill.SpillWriter(str(tmp_path), "lz4")
+
+
+def test_extract_to_spill(tmp_path):
+    cursor = get_mock_cursor()
+    named_cursor = get_mock_cursor()
+    type(named_cursor).description=PropertyMock(return_value=[("id", 23), ("ts", 1184)])
+    first, second = datetime(2020, 1, 1, tzinfo=timezone.utc), datetime(2020, 1, 2, tzinfo=timezone.utc)
+    named_cursor.fetchmany=MagicMock(side_effect=[[(1, second), (2, first)], [(3, None)], []])
+    ctx = mock_connection(cursor)
+    ctx.__enter__.return_value[0].cursor=MagicMock(return_value=named_cursor)
+    directory = str(tmp_path / "spill")
+    stats = etl.CopyStats()
+
+    result = etl.extract_to_spill(etl.Relation("src", "src_sch", "src_rel"), "ts", first, directory,
+                                  batch_size=2, stats=stats)
+
+    assert result == second
+    manifest = spill.read_manifest(directory)
+    assert manifest["columns"] == ["id", "ts"]
+    assert manifest["since"] == first.isoformat()
+    assert [(batch["rows"], batch["watermark"]) for batch in manifest["batches"]] == \
+        [(2, second.isoformat()), (1, None)]
+    assert list(spill.read_batches(directory, manifest)) == \
+        [(0, f"1\t{second.isoformat()}\n2\t{first.isoformat()}\n".encode()), (1, b"3\t\\N\n")]
+    assert (stats.rows_extracted, stats.batches) == (3, 2)
+
+
+def test_extract_to_spill_failure_leaves_no_spill(tmp_path):
+    cursor = get_mock_cursor()
+    named_cursor = get_mock_cursor()
+    type(named_cursor).description=PropertyMock(return_value=[("id", 23), ("ts", 1184)])
+    named_cursor.fetchmany=MagicMock(side_effect=[[(1, None)], psycopg2.OperationalError("mock")])
+    ctx = mock_connection(cursor)
+    ctx.__exit__.return_value = False
+    ctx.__enter__.return_value[0].cursor=MagicMock(return_value=named_cursor)
+
+    with pytest.raises(psycopg2.OperationalError):
+        etl.extract_to_spill(etl.Relation("src", "src_sch", "src_rel"), "ts", None, str(tmp_path / "spill"))
+    assert not (tmp_path / "spill").exists()
+
+
+def write_spill(directory, batches):
+    writer = spill.SpillWriter(directory, columns=["id", "ts"])
+    for payload, rows, watermark in batches:
+        writer.write(payload, rows, watermark)
+    writer.close()
+
+
+def test_load_spill_resumes(tmp_path):
+    cursor = get_mock_cursor()
+    cursor.copy_expert=MagicMock(side_effect=lambda query, file, size: file.read(size))
+    cursor.rowcount=1
+    mock_connection(cursor)
+    directory = str(tmp_path / "spill")
+    write_spill(directory, [(b"1\t2020-01-03\n", 1, "2020-01-03T00:00:00+00:00"),
+                            (b"2\t2020-01-01\n", 1, "2020-01-01T00:00:00+00:00"),
+                            (b"3\t2020-01-02\n", 1, "2020-01-02T00:00:00+00:00")])
+    spill.mark_loaded(directory, 1)
+    tgt = etl.Relation("tgt", "tgt_sch", "tgt_rel")
+    log = etl.Relation("tgt", "public", "log_mock")
+    stats = etl.CopyStats()
+
+    with patch.object(etl, "log_upload") as log_upload:
+        result = etl.load_spill(directory, tgt, "id", log, stats=stats)
+
+    assert result == datetime(2020, 1, 3, tzinfo=timezone.utc)
+    copies = cursor.copy_expert.call_args_list
+    assert [c.args[0] for c in copies] == ['COPY "etl_staging_tgt_rel" ("id", "ts") FROM STDIN'] * 2
+    # Only the last batch moves the watermark, to the latest one in the whole spill
+    log_upload.assert_called_once_with(tgt, log, result, curs=cursor)
+    assert (stats.rows_extracted, stats.rows_inserted, stats.batches) == (2, 2, 2)
+    assert not (tmp_path / "spill").exists()
+
+
+def test_load_spill_compressed(tmp_path):
+    cursor = get_mock_cursor()
+    copied = []
+    cursor.copy_expert=MagicMock(side_effect=lambda query, file, size: copied.append(file.read()))
+    mock_connection(cursor)
+    directory = str(tmp_path / "spill")
+    writer = spill.SpillWriter(directory, "gzip", columns=["id"])
+    writer.write(b"1\n", 1, None)
+    writer.write(b"2\n", 1, None)
+    writer.close()
+
+    etl.load_spill(directory, etl.Relation("tgt", "tgt_sch", "tgt_rel"), "id")
+
+    assert copied == [b"1\n", b"2\n"]
+
+
+def test_load_spill_failure_keeps_progress(tmp_path):
+    cursor = get_mock_cursor()
+    cursor.copy_expert=MagicMock(side_effect=[None, psycopg2.OperationalError("mock")])
+    ctx = mock_connection(cursor)
+    ctx.__exit__.return_value = False
+    directory = str(tmp_path / "spill")
+    write_spill(directory, [(b"1\n", 1, None), (b"2\n", 1, None)])
+
+    with pytest.raises(psycopg2.OperationalError):
+        etl.load_spill(directory, etl.Relation("tgt", "tgt_sch", "tgt_rel"), "id")
+    assert spill.loaded_batches(directory) == 1
+
+
+def test_copy_spilled_loads_pending_spill_first(tmp_path):
+    cursor = get_mock_cursor()
+    cursor.copy_expert=MagicMock()
+    mock_connection(cursor)
+    directory = str(tmp_path / "spill")
+    write_spill(directory, [(b"1\n", 1, "2020-01-01T00:00:00+00:00")])
+
+    with patch.object(etl, "extract_to_spill") as extract_to_spill:
+        result = etl.copy_spilled(etl.Relation("src", "src_sch", "src_rel"), etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+                                  "id", "ts", None, directory)
+
+    assert result == datetime(2020, 1, 1, tzinfo=timezone.utc)
+    extract_to_spill.assert_not_called()
+    etl.connect.assert_called_once_with("tgt")
+
+
+@pytest.mark.parametrize("phase, loaded", [("extract", False), ("load", True), ("both", True)])
+def test_copy_spilled_phases(tmp_path, phase, loaded):
+    directory = str(tmp_path / "spill")
+    with patch.object(etl, "extract_to_spill") as extract_to_spill, patch.object(etl, "load_spill") as load_spill:
+        etl.copy_spilled(etl.Relation("src", "src_sch", "src_rel"), etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+                         "id", "ts", None, directory, phase)
+
+    assert extract_to_spill.called == (phase != "load")
+    # Without a spill to begin with, loading only is a no-op
+    assert load_spill.called == (phase == "both")
+
+
+def test_copy_table_spill(tmp_path):
+    table = etl.Table(etl.Relation("src", "src_sch", "src_rel"), etl.Relation("tgt", "tgt_sch", "tgt_rel"), "id", "ts")
+    log = etl.Relation("tgt", "public", "log_mock")
+    with patch.object(etl, "copy_spilled", return_value=None) as copy_spilled:
+        etl.copy_table(table, log, {"batch_size": 100}, checkpoints={}, spill_dir=str(tmp_path),
+                       spill_phase="extract", spill_compression="gzip")
+
+    copy_spilled.assert_called_once_with(table.source, table.target, "id", "ts", None,
+                                         str(tmp_path / "tgt.tgt_sch.tgt_rel"), "extract", "gzip",
+                                         log=log, previous=None, stats=ANY, batch_size=100)
+
+
+def test_enable_passthrough():
+    cursor = get_mock_cursor()
+    fetch_cursor = get_mock_cursor()
+    # id, a domain over text, a second timestamptz column and the watermark
+    cursor.fetchall=MagicMock(return_value=[("id", 23, 0), ("code", 90000, 25), ("updated", 1184, 0),
+                                            ("ts", 1184, 0)])
+
+    with patch.object(psycopg2.extensions, "register_type") as register_type:
+        etl.enable_passthrough(cursor, fetch_cursor, etl.Relation("src", "src_sch", "src_rel"), "ts")
+
+    assert cursor.execute.call_args.args[1] == ("src_sch", "src_rel")
+    caster, scope = register_type.call_args.args
+    assert scope is fetch_cursor
+    assert caster.values == (23, 25, 90000)
+    assert caster("2020-01-01 00:00:00+00", None) == "2020-01-01 00:00:00+00"
+
+
+def test_copy_passthrough():
+    cursor = get_mock_cursor()
+    type(cursor).description=PropertyMock(return_value=[("id", 23), ("ts", 1184)])
+    cursor.executemany=MagicMock()
+    cursor.fetchall=MagicMock(return_value=[("1", 1), ("2", 2)])
+    mock_connection(cursor)
+
+    with patch.object(etl, "enable_passthrough") as enable_passthrough:
+        result = etl.copy(etl.Relation("src", "src_sch", "src_rel"), etl.Relation("tgt", "tgt_sch", "tgt_rel"),
+                          "id", "ts", None, passthrough=True)
+
+    assert result == 2
+    enable_passthrough.assert_called_once_with(cursor, cursor, etl.Relation("src", "src_sch", "src_rel"), "ts")
+    # The text values go to the target unchanged
+    assert cursor.executemany.call_args.args[1] == [("1", 1), ("2", 2)]
+
+
+@pytest.mark.parametrize("options, partitions, ignored",
+                         [
+                             ({"strategy": "merge"}, 0, None),
+                             ({"strategy": "pushdown"}, 0, "pushdown strategy"),
+                             ({"strategy": "copy"}, 0, "copy strategy"),
+                             ({"strategy": "merge"}, 4, "partitions"),
+                         ])
+def test_copy_table_spill_ignored_settings(tmp_path, options, partitions, ignored):
+    table = etl.Table(etl.Relation("src", "src_sch", "src_rel"), etl.Relation("tgt", "tgt_sch", "tgt_rel"), "id", "ts")
+    with patch.object(etl, "copy_spilled", return_value=None), patch.object(etl, "copy_partitioned") as partitioned, \
+            warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        etl.copy_table(table, etl.Relation("tgt", "public", "log_mock"), options, checkpoints={},
+                       partitions=partitions, spill_dir=str(tmp_path))
+
+    partitioned.assert_not_called()
+    messages = [str(w.message) for w in caught if issubclass(w.category, RuntimeWarning)]
+    if ignored:
+        assert len(messages) == 1 and ignored in messages[0]
+    else:
+        assert messages == []
+
+
+def test_run_spill_load_phase_leaves_source_alone(tmp_path):
+    settings = dict(etl.DEFAULT_SETTINGS, spill_dir=str(tmp_path), spill_phase="load", consistent_snapshot=True,
+                    preflight=True)
+    with patch.object(etl, "get_columns") as get_columns, \
+         patch.object(etl, "make_sure_table_exists") as make_sure_table_exists, \
+         patch.object(etl, "make_sure_columns_exist"), patch.object(etl, "make_sure_primary_key_exists"), \
+         patch.object(etl, "make_sure_index_exists"), patch.object(etl, "get_checkpoints", return_value={}), \
+         patch.object(etl, "exported_snapshot") as exported_snapshot, \
+         patch.object(etl, "check_extraction_plan") as check_extraction_plan, \
+         patch.object(etl, "copy_spilled", return_value=None) as copy_spilled, \
+         patch.object(etl, "record_run"):
+        results = etl.run(settings)
+
+    get_columns.assert_not_called()
+    exported_snapshot.assert_not_called()
+    check_extraction_plan.assert_not_called()
+    assert {c.args[0].name for c in make_sure_table_exists.call_args_list} == {"etl_runs", "etl_run_history"}
+    assert [c.args[6] for c in copy_spilled.call_args_list] == ["load", "load"]
+    assert not any(result.error for result in results)